@@ -0,0 +1,60 @@
+# Микро-бенчмарк классификатора транзакций на корпусе записанных транзакций.
+#
+# Запуск из корня репозитория:
+#     python benchmarks/bench_classifier.py [--iterations 20000]
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+# bot.py требует токен при импорте, для бенчмарка подойдёт любой
+os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+def load_corpus():
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(CORPUS_DIR, "*.json"))):
+        with open(path, encoding="utf-8") as f:
+            record = json.load(f)
+        corpus.append((os.path.basename(path)[:-5], record))
+    return corpus
+
+def main():
+    parser = argparse.ArgumentParser(description="Стоимость classify_transaction на одну транзакцию")
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    if not corpus:
+        sys.exit(f"Корпус пуст: {CORPUS_DIR}")
+
+    failed = False
+    total = 0.0
+    print(f"{'транзакция':<16} {'тип':<12} {'мкс/tx':>8}")
+    for name, record in corpus:
+        tx = bot.decode_transaction(json.dumps(record["transaction"]))
+        wallet = record["wallet"]
+        classification = bot.classify_transaction(tx, wallet)
+        if record.get("expected_type") and classification.tx_type != record["expected_type"]:
+            print(f"{name}: ожидался {record['expected_type']}, получен {classification.tx_type}")
+            failed = True
+
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            bot.classify_transaction(tx, wallet)
+        per_tx = (time.perf_counter() - started) / args.iterations
+        total += per_tx
+        print(f"{name:<16} {classification.tx_type:<12} {per_tx * 1e6:>8.2f}")
+
+    print(f"{'среднее':<29} {total / len(corpus) * 1e6:>8.2f}")
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# Декодирование сообщений до и после типизированного слоя: время и аллокации на сообщение.
+#
+# "до" — json.loads всего сообщения в словари и обход нужных полей, как раньше;
+# "после" — декодеры msgspec из bot.py, которые создают только нужные поля.
+#
+# Запуск из корня репозитория:
+#     python benchmarks/bench_decode.py [--iterations 2000]
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+# bot.py требует токен при импорте, для бенчмарка подойдёт любой
+os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+# Прежний путь: словари целиком, поля цепочками .get()
+def before_program(raw):
+    data = json.loads(raw).get("params", {}).get("result", {}).get("value", {}).get("account", {}).get("data")
+    return data.get("parsed", {}).get("info", {}).get("owner") if isinstance(data, dict) else None
+
+def before_logs(raw):
+    value = json.loads(raw).get("params", {}).get("result", {}).get("value", {})
+    return value.get("signature"), value.get("err")
+
+def before_rpc(raw):
+    return [resp.get("result") for resp in json.loads(raw)]
+
+def after_program(raw):
+    data = bot.program_message_decoder.decode(raw).params.result.value.account.data
+    return data.parsed.info.owner if isinstance(data, bot.AccountData) and data.parsed is not None else None
+
+def after_logs(raw):
+    value = bot.logs_message_decoder.decode(raw).params.result.value
+    return value.signature, value.err
+
+def after_rpc(raw):
+    return [bot.transaction_decoder.decode(resp.result) for resp in bot.rpc_response_decoder.decode(raw)]
+
+# Сообщения в том виде, в каком они приходят по сети
+def build_messages():
+    txs = []
+    for path in sorted(glob.glob(os.path.join(CORPUS_DIR, "*.json"))):
+        with open(path, encoding="utf-8") as f:
+            record = json.load(f)
+        txs.append((record["signature"], record["transaction"]))
+
+    messages = {"programNotification": [], "logsNotification": [], "getTransaction (батч)": []}
+    for i, (signature, tx) in enumerate(txs):
+        keys = [key if isinstance(key, str) else key["pubkey"] for key in tx["transaction"]["message"]["accountKeys"]]
+        # Уведомление программы — изменённый токен-аккаунт в jsonParsed
+        for balance in tx["meta"].get("postTokenBalances") or ():
+            messages["programNotification"].append(json.dumps({
+                "jsonrpc": "2.0", "method": "programNotification",
+                "params": {"subscription": 1, "result": {"context": {"slot": 300000000 + i}, "value": {
+                    "pubkey": keys[balance["accountIndex"]],
+                    "account": {
+                        "data": {"program": "spl-token", "space": 165, "parsed": {"type": "account", "info": {
+                            "isNative": False, "mint": balance["mint"], "owner": balance.get("owner"),
+                            "state": "initialized", "tokenAmount": balance["uiTokenAmount"],
+                        }}},
+                        "executable": False, "lamports": 2039280, "owner": bot.SPL_TOKEN_PROGRAM_ID,
+                        "rentEpoch": 18446744073709551615, "space": 165,
+                    },
+                }}},
+            }))
+        messages["logsNotification"].append(json.dumps({
+            "jsonrpc": "2.0", "method": "logsNotification",
+            "params": {"subscription": 1, "result": {"context": {"slot": 300000000 + i}, "value": {
+                "signature": signature, "err": None, "logs": tx["meta"].get("logMessages") or [],
+            }}},
+        }))
+    messages["getTransaction (батч)"].append(json.dumps([
+        {"jsonrpc": "2.0", "id": i, "result": tx} for i, (_, tx) in enumerate(txs)
+    ]).encode())
+    return messages
+
+def time_per_message(decode, messages, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for raw in messages:
+            decode(raw)
+    return (time.perf_counter() - started) / (iterations * len(messages))
+
+# Аллокации на сообщение: блоки и байты, которые живут вместе с результатом, и пик при декодировании
+def allocations_per_message(decode, messages):
+    decode(messages[0])  # Прогрев кэшей интерпретатора
+    tracemalloc.start()
+    blocks_before = sys.getallocatedblocks()
+    results = [decode(raw) for raw in messages]
+    blocks = sys.getallocatedblocks() - blocks_before
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del results
+    return blocks / len(messages), retained / len(messages), peak / len(messages)
+
+def main():
+    parser = argparse.ArgumentParser(description="Декодирование сообщений: до и после типизированного слоя")
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    cases = {
+        "programNotification": (before_program, after_program),
+        "logsNotification": (before_logs, after_logs),
+        "getTransaction (батч)": (before_rpc, after_rpc),
+    }
+    messages = build_messages()
+
+    print(f"{'сообщение':<24} {'':<6} {'мкс/сообщ':>10} {'блоков':>8} {'байт':>8} {'пик, байт':>10}")
+    for name, (before, after) in cases.items():
+        for label, decode in (("до", before), ("после", after)):
+            per_message = time_per_message(decode, messages[name], args.iterations)
+            blocks, retained, peak = allocations_per_message(decode, messages[name])
+            print(f"{name:<24} {label:<6} {per_message * 1e6:>10.2f} {blocks:>8.0f} {retained:>8.0f} {peak:>10.0f}")
+
+if __name__ == "__main__":
+    main()
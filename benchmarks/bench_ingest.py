@@ -0,0 +1,56 @@
+# Сравнение режимов приёма: общие подписки на программы против logsSubscribe с mentions.
+#
+# Оба прогона идут через bench_pipeline.py в отдельных процессах (INGEST_MODE читается
+# при импорте бота) на одном и том же потоке, где наши кошельки — лишь доля транзакций.
+#
+# Запуск из корня репозитория:
+#     python benchmarks/bench_ingest.py --wallets 200 --rate 200 --duration 15 --match-ratio 0.05
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+BENCH_PIPELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_pipeline.py")
+
+# Строки сравнения: ключ отчёта, подпись, формат
+ROWS = [
+    ("matched", "наших транзакций", "{:.0f}"),
+    ("alerts_delivered", "уведомлений доставлено", "{:.0f}"),
+    ("ws_bytes", "байт по WebSocket", "{:.0f}"),
+    ("ws_bytes_per_matched", "байт на нашу транзакцию", "{:.0f}"),
+    ("cpu_seconds", "CPU бота, с", "{:.2f}"),
+    ("cpu_ms_per_matched", "CPU на нашу транзакцию, мс", "{:.3f}"),
+    ("latency_p50_ms", "задержка p50, мс", "{:.1f}"),
+    ("latency_p99_ms", "задержка p99, мс", "{:.1f}"),
+]
+
+def run_mode(mode, passthrough):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, f"{mode}.json")
+        subprocess.run(
+            [sys.executable, BENCH_PIPELINE, "--mode", mode, "--json", path, *passthrough],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение режимов приёма program и logs")
+    parser.add_argument("--match-ratio", default="0.05", help="доля транзакций потока, затрагивающих наши кошельки")
+    parser.add_argument("--json", help="куда сохранить оба отчёта в JSON")
+    args, passthrough = parser.parse_known_args()
+    passthrough += ["--match-ratio", args.match_ratio]
+
+    reports = {mode: run_mode(mode, passthrough) for mode in ("program", "logs")}
+
+    print(f"{'':<28} {'program':>12} {'logs':>12}")
+    for key, label, fmt in ROWS:
+        print(f"{label:<28} {fmt.format(reports['program'][key]):>12} {fmt.format(reports['logs'][key]):>12}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(reports, f, indent=2, ensure_ascii=False)
+
+if __name__ == "__main__":
+    main()
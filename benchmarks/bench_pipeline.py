@@ -0,0 +1,351 @@
+# Нагрузочный тест конвейера уведомлений: подписка -> getTransaction -> классификация -> sendMessage.
+#
+# Записанные транзакции проигрываются поддельным узлом Solana с заданной частотой
+# (уведомления program/account/logs он строит по самой транзакции), уведомления принимает
+# поддельный Telegram Bot API. Подделки работают в отдельном процессе, чтобы не искажать
+# замеры event loop бота.
+#
+# Запуск из корня репозитория:
+#     python benchmarks/bench_pipeline.py --wallets 200 --rate 100 --duration 20
+#     python benchmarks/bench_pipeline.py --replay recorded.jsonl --json baseline.json
+#     python benchmarks/bench_pipeline.py --mode logs --match-ratio 0.05
+#     python benchmarks/bench_pipeline.py --mode logs --shards 4 --rate 2000
+#     python benchmarks/bench_pipeline.py --wallets 100 --subscribers 10
+#     python benchmarks/bench_pipeline.py --mode logs --alert-mode fast --confirm-delay 1.0 --fail-ratio 0.05
+#
+# Файл --replay (JSONL) пишет benchmarks/record.py; без него используется корпус
+# benchmarks/corpus, где адрес кошелька в каждой транзакции подменяется на отслеживаемый.
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakes  # noqa: E402
+
+# Типы, на которые подписаны все кошельки бенчмарка
+BENCH_TYPES = ["swap", "transfer", "approvals", "nft_mint", "wrap", "contract_creation", "receive", "send"]
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+# Корпус транзакций -> элементы проигрывания; уведомления по транзакции строит поддельный узел
+def corpus_replay():
+    items = []
+    for path in sorted(glob.glob(os.path.join(ROOT, "benchmarks", "corpus", "*.json"))):
+        with open(path, encoding="utf-8") as f:
+            record = json.load(f)
+        items.append({"wallet": record["wallet"], "signature": record["signature"], "transaction": record["transaction"]})
+    return items
+
+# Токен-аккаунты, которыми владеет кошелёк шаблона: при подмене кошелька у каждого адреса свои
+def owned_token_accounts(item):
+    transaction = item["transaction"]
+    keys = [key if isinstance(key, str) else key["pubkey"] for key in transaction["transaction"]["message"]["accountKeys"]]
+    meta = transaction.get("meta") or {}
+    balances = (meta.get("preTokenBalances") or []) + (meta.get("postTokenBalances") or [])
+    return sorted({keys[balance["accountIndex"]] for balance in balances if balance.get("owner") == item["wallet"]})
+
+def load_replay(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# Процесс с подделками: поднимает серверы, проигрывает уведомления и собирает статистику
+def fakes_main(conn, items, rate, duration, rpc_latency, drain, match_ratio, confirm_delay, fail_ratio):
+    asyncio.run(run_fakes(conn, items, rate, duration, rpc_latency, drain, match_ratio, confirm_delay, fail_ratio))
+
+async def run_fakes(conn, items, rate, duration, rpc_latency, drain, match_ratio, confirm_delay, fail_ratio):
+    from solders.pubkey import Pubkey
+    from solders.signature import Signature
+
+    loop = asyncio.get_running_loop()
+    solana = fakes.FakeSolana(rpc_latency=rpc_latency, confirm_delay=confirm_delay)
+    telegram = fakes.FakeTelegram(solana)
+    ws_port, http_port = await solana.start()
+    tg_port = await telegram.start()
+    conn.send((ws_port, http_port, tg_port))
+
+    wallets = await loop.run_in_executor(None, conn.recv)
+    # Бот ставит точку отсчёта догрузки каждому адресу (getSignaturesForAddress): до этого
+    # транзакции кошелька считались бы его старой историей
+    deadline = time.monotonic() + 30
+    while solana.rpc_calls.get("getSignaturesForAddress", 0) < len(wallets) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    templates = [(item, json.dumps(item), owned_token_accounts(item)) for item in items]
+    token_accounts = {}  # (кошелёк, токен-аккаунт шаблона) -> токен-аккаунт кошелька
+    total = int(rate * duration)
+    rng = random.Random(1)
+    # Чужие кошельки: основная часть реального потока программ нас не касается.
+    # Pubkey.new_unique() — счётчик процесса и повторил бы адреса бота, поэтому ключи случайные
+    strangers = [str(Pubkey(os.urandom(32))) for _ in range(1000)]
+    matched = 0
+    failed = 0
+
+    started = time.monotonic()
+    for i in range(total):
+        delay = started + i / rate - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        item, template, accounts = templates[i % len(templates)]
+        signature = str(Signature.new_unique())
+        ours = rng.random() < match_ratio
+        if ours:
+            wallet = rng.choice(wallets)
+            matched += 1
+        else:
+            wallet = rng.choice(strangers)
+        text = template.replace(item["wallet"], wallet).replace(item["signature"], signature)
+        for account in accounts:
+            if (wallet, account) not in token_accounts:
+                token_accounts[(wallet, account)] = str(Pubkey(os.urandom(32)))
+            text = text.replace(account, token_accounts[(wallet, account)])
+        data = json.loads(text)
+        if ours and rng.random() < fail_ratio:
+            # Прошла на processed, но подтверждённая версия упала: быстрое уведомление должно быть отозвано
+            data["transaction"]["meta"]["err"] = {"InstructionError": [0, {"Custom": 1}]}
+            failed += 1
+        solana.transactions[signature] = data["transaction"]
+        logs = data["transaction"]["meta"].get("logMessages") or ()
+        await solana.publish(signature, data["transaction"], 300000000 + i, logs)
+    replay_time = time.monotonic() - started
+
+    # Ждём, пока бот дошлёт хвост очереди
+    deadline = time.monotonic() + drain
+    last = -1
+    while time.monotonic() < deadline and telegram.messages != last:
+        last = telegram.messages
+        await asyncio.sleep(1.0)
+
+    conn.send({
+        "ws_subscriptions": len(solana.subscriptions),
+        "notifications": total,
+        "matched": matched,
+        "failed": failed,
+        "replay_time": replay_time,
+        "ws_bytes": solana.bytes_sent,
+        "rpc_requests": solana.rpc_requests,
+        "rpc_calls": solana.rpc_calls,
+        "telegram_messages": telegram.messages,
+        "latencies": telegram.latencies,
+        "edit_latencies": telegram.edit_latencies,
+        "deleted": telegram.deleted,
+    })
+    # Серверы держим, пока бот не закроет свои подписки
+    await loop.run_in_executor(None, conn.recv)
+    await solana.stop()
+    await telegram.stop()
+
+async def run_bot(args, conn):
+    ws_port, http_port, tg_port = conn.recv()
+    os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+    os.environ["SOLANA_WS_URL"] = f"ws://127.0.0.1:{ws_port}"
+    os.environ["SOLANA_HTTP_URL"] = f"http://127.0.0.1:{http_port}"
+    os.environ["PRICE_BACKEND"] = "stub"
+    os.environ["WALLETS_DB_PATH"] = ":memory:"
+    os.environ["INGEST_MODE"] = args.mode
+    os.environ["ALERT_MODE"] = args.alert_mode
+    # Воркеры шардов наследуют окружение: без логов каждого уведомления
+    os.environ["LOG_LEVEL"] = "WARNING"
+
+    import telegram
+    from solders.pubkey import Pubkey
+    import bot
+
+    # Логи каждого уведомления заметно тормозят бенчмарк
+    logging.getLogger().setLevel(logging.WARNING)
+
+    bot.notifier.global_bucket = bot.TokenBucket(args.telegram_rate, args.telegram_rate)
+    tg = telegram.Bot(bot.BOT_TOKEN, base_url=f"http://127.0.0.1:{tg_port}/bot")
+    await tg.initialize()
+    bot.notifier.start(tg)
+    bot.token_cache.start()
+    if args.shards:
+        bot.shard_coordinator = bot.ShardCoordinator(args.shards)
+        bot.shard_coordinator.start()
+
+    # Регистрация кошельков: память считаем только на этом этапе.
+    # Каждый адрес отслеживают args.subscribers разных чатов
+    wallets = [str(Pubkey.new_unique()) for _ in range(args.wallets)]
+    types = bot.types_mask(BENCH_TYPES)
+    subscriptions = args.wallets * args.subscribers
+    tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+    for i, address in enumerate(wallets):
+        for j in range(args.subscribers):
+            name = f"bench{i}"
+            chat_id = 1000 + (i + j) % args.chats
+            bot.tracked_wallets[(chat_id, name)] = {"address": address, "chat_id": chat_id, "name": name, "types": types}
+            await bot.monitor_wallet(address, chat_id, name, types)
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if args.shards:
+            subscriptions_ready = bot.shard_coordinator.covered(subscriptions)
+        else:
+            subscriptions_ready = bot.subscriptions_covered()
+        if subscriptions_ready:
+            break
+        await asyncio.sleep(0.1)
+    memory_used = tracemalloc.get_traced_memory()[0] - memory_before
+    tracemalloc.stop()
+
+    lag_monitor = bot.EventLoopLagMonitor(interval=0.01, history=1_000_000)
+    lag_monitor.start()
+    # Процессорное время бота за проигрывание: подделки живут в другом процессе и сюда не попадают
+    cpu_before = time.process_time()
+    conn.send(wallets)
+    stats = await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+    cpu_time = time.process_time() - cpu_before
+    await lag_monitor.stop()
+
+    latencies = stats.pop("latencies")
+    edit_latencies = stats.pop("edit_latencies")
+    notifications = stats["notifications"]
+    matched = max(1, stats["matched"])
+    report = {
+        "mode": args.mode,
+        "alert_mode": args.alert_mode,
+        "confirm_delay": args.confirm_delay,
+        "shards": args.shards,
+        "wallets": args.wallets,
+        "subscribers": args.subscribers,
+        "chats": args.chats,
+        "ws_subscriptions": stats["ws_subscriptions"],
+        "rate": args.rate,
+        "notifications": notifications,
+        "matched": stats["matched"],
+        "messages_per_sec": notifications / stats["replay_time"] if stats["replay_time"] else 0.0,
+        "alerts_delivered": len(latencies),
+        "telegram_messages": stats["telegram_messages"],
+        "digests": bot.notifier.digests,
+        "pipeline_shed": bot.pipeline.shed,
+        "alerts_rendered": rendered_alerts(bot),
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p95_ms": percentile(latencies, 95) * 1000,
+        "latency_p99_ms": percentile(latencies, 99) * 1000,
+        "confirmed_edits": len(edit_latencies),
+        "confirm_latency_p50_ms": percentile(edit_latencies, 50) * 1000,
+        "confirm_latency_p99_ms": percentile(edit_latencies, 99) * 1000,
+        "failed": stats["failed"],
+        "retracted": stats["deleted"],
+        "memory_per_wallet_bytes": memory_used / max(1, args.wallets),
+        "memory_per_subscription_bytes": memory_used / max(1, subscriptions),
+        "loop_lag_p50_ms": percentile(lag_monitor.samples, 50) * 1000,
+        "loop_lag_p99_ms": percentile(lag_monitor.samples, 99) * 1000,
+        "loop_lag_max_ms": lag_monitor.max_lag * 1000,
+        "ws_bytes": stats["ws_bytes"],
+        "ws_bytes_per_matched": stats["ws_bytes"] / matched,
+        "cpu_seconds": cpu_time,
+        "cpu_ms_per_matched": cpu_time * 1000 / matched,
+        "rpc_requests": stats["rpc_requests"],
+        "rpc_calls": stats["rpc_calls"],
+    }
+
+    if args.shards:
+        # CPU воркеров видно только после их завершения (RUSAGE_CHILDREN), вместе со временем запуска
+        await bot.shard_coordinator.stop()
+        report["cpu_seconds_shards"] = cpu_children(resource.getrusage(resource.RUSAGE_CHILDREN))
+    await bot.program_hub.stop()
+    await bot.logs_pool.stop()
+    await bot.account_pool.stop()
+    await bot.pipeline.stop()
+    await bot.notifier.stop()
+    await bot.token_cache.stop()
+    await bot.tx_fetcher.close()
+    await tg.shutdown()
+    for task in asyncio.all_tasks() - {asyncio.current_task()}:
+        task.cancel()
+    conn.send("stop")
+    return report
+
+# Уведомления, прошедшие render: пропускная способность мониторинга без учёта лимитов Telegram
+def rendered_alerts(bot):
+    counters = bot.shard_coordinator.counters() if bot.shard_coordinator is not None else bot.metrics.counters.items()
+    return sum(
+        value for (name, labels), value in counters
+        if name == "dtracker_pipeline_processed_total" and ("stage", "render") in labels
+    )
+
+def cpu_children(usage):
+    return usage.ru_utime + usage.ru_stime
+
+def print_report(report):
+    print(f"режим приёма:                {report['mode']}" + (f", шардов: {report['shards']}" if report["shards"] else ""))
+    print(f"адресов / подписок / чатов:  {report['wallets']} / {report['wallets'] * report['subscribers']} / {report['chats']}")
+    print(f"подписок у узла Solana:      {report['ws_subscriptions']}")
+    print(f"транзакций в потоке:         {report['notifications']} ({report['messages_per_sec']:.1f} в секунду), наших: {report['matched']}")
+    print(f"уведомлений доставлено:      {report['alerts_delivered']} в {report['telegram_messages']} сообщениях (сводок: {report['digests']}, сброшено при перегрузке: {report['pipeline_shed']})")
+    print(f"уведомлений сформировано:    {report['alerts_rendered']}")
+    print(f"задержка p50/p95/p99, мс:    {report['latency_p50_ms']:.1f} / {report['latency_p95_ms']:.1f} / {report['latency_p99_ms']:.1f} (до первого сообщения, режим {report['alert_mode']}, подтверждение через {report['confirm_delay']:.1f} с)")
+    if report["alert_mode"] == "fast":
+        print(f"правок после подтверждения:  {report['confirmed_edits']}, задержка p50/p99: {report['confirm_latency_p50_ms']:.1f} / {report['confirm_latency_p99_ms']:.1f} мс")
+        print(f"упавших / отозванных:        {report['failed']} / {report['retracted']}")
+    print(f"память на адрес / подписку:  {report['memory_per_wallet_bytes'] / 1024:.2f} / {report['memory_per_subscription_bytes'] / 1024:.2f} КБ")
+    print(f"лаг event loop p50/p99/max:  {report['loop_lag_p50_ms']:.2f} / {report['loop_lag_p99_ms']:.2f} / {report['loop_lag_max_ms']:.2f} мс")
+    print(f"байт по WebSocket:           {report['ws_bytes']} ({report['ws_bytes_per_matched']:.0f} на нашу транзакцию)")
+    print(f"CPU бота:                    {report['cpu_seconds']:.2f} с ({report['cpu_ms_per_matched']:.2f} мс на нашу транзакцию)")
+    if report["shards"]:
+        print(f"CPU воркеров шардов:         {report['cpu_seconds_shards']:.2f} с")
+    print(f"HTTP-запросов к RPC:         {report['rpc_requests']} {report['rpc_calls']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест конвейера уведомлений")
+    parser.add_argument("--wallets", type=int, default=200, help="уникальных адресов")
+    parser.add_argument("--subscribers", type=int, default=1, help="сколько чатов отслеживают каждый адрес")
+    parser.add_argument("--chats", type=int, default=50, help="по скольким чатам распределить кошельки")
+    parser.add_argument("--rate", type=float, default=100.0, help="уведомлений WebSocket в секунду")
+    parser.add_argument("--duration", type=float, default=20.0, help="длительность проигрывания, сек")
+    parser.add_argument("--rpc-latency", type=float, default=0.02, help="задержка ответа RPC, сек")
+    parser.add_argument("--telegram-rate", type=float, default=30.0, help="глобальный лимит sendMessage в секунду")
+    parser.add_argument("--mode", choices=("program", "logs"), default="program", help="режим приёма (INGEST_MODE)")
+    parser.add_argument("--match-ratio", type=float, default=1.0, help="доля транзакций потока, затрагивающих наши кошельки")
+    parser.add_argument("--shards", type=int, default=0, help="мониторинг в стольких процессах-воркерах (SHARD_WORKERS)")
+    parser.add_argument("--alert-mode", choices=("confirmed", "fast"), default="confirmed", help="режим уведомлений (ALERT_MODE)")
+    parser.add_argument("--confirm-delay", type=float, default=0.0, help="через сколько секунд после processed транзакция подтверждается")
+    parser.add_argument("--fail-ratio", type=float, default=0.0, help="доля наших транзакций, упавших при подтверждении")
+    parser.add_argument("--drain", type=float, default=30.0, help="сколько ждать хвост очереди после проигрывания, сек")
+    parser.add_argument("--replay", help="JSONL с записанными уведомлениями и транзакциями")
+    parser.add_argument("--json", help="куда сохранить отчёт в JSON")
+    args = parser.parse_args()
+    if args.shards and args.mode != "logs":
+        parser.error("--shards требует --mode logs (SHARD_WORKERS работает только с INGEST_MODE=logs)")
+    args.chats = max(1, min(args.chats, args.wallets * args.subscribers))
+    args.subscribers = max(1, min(args.subscribers, args.chats))
+    items = load_replay(args.replay) if args.replay else corpus_replay()
+
+    ctx = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = ctx.Pipe()
+    process = ctx.Process(
+        target=fakes_main,
+        args=(child_conn, items, args.rate, args.duration, args.rpc_latency, args.drain, args.match_ratio, args.confirm_delay, args.fail_ratio),
+        daemon=True,
+    )
+    process.start()
+    try:
+        report = asyncio.run(run_bot(args, parent_conn))
+    finally:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# Задержка от обновления Telegram до ответа бота: long polling против вебхука.
+#
+# Бот запускается отдельным процессом против локального поддельного Bot API. Тот кладёт
+# команды /start из разных чатов либо в очередь getUpdates, либо отправляет POST на вебхук,
+# и засекает время до первого sendMessage в этот чат.
+#
+# Запуск из корня репозитория:
+#     python benchmarks/bench_updates.py --updates 300 --rate 50
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeTelegram  # noqa: E402
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bot.py")
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+async def run_mode(mode, args):
+    telegram = FakeTelegram()
+    telegram_port = await telegram.start()
+    port = free_port()
+    env = dict(
+        os.environ,
+        BOT_TOKEN="0:benchmark",
+        TELEGRAM_API_URL=f"http://127.0.0.1:{telegram_port}/bot",
+        TELEGRAM_MODE=mode,
+        WEBHOOK_URL=f"http://127.0.0.1:{port}",
+        PORT=str(port),
+        PRICE_BACKEND="stub",
+        WALLETS_DB_PATH=":memory:",
+        SOLANA_WS_URL="ws://127.0.0.1:9",
+        SOLANA_HTTP_URL="http://127.0.0.1:9",
+        # Меряем путь обновления, а не лимиты Telegram на рассылку
+        TELEGRAM_GLOBAL_RATE="100000",
+        LOG_LEVEL="WARNING",
+    )
+    process = await asyncio.create_subprocess_exec(sys.executable, BOT_PATH, env=env)
+    try:
+        await asyncio.wait_for(telegram.ready.wait(), timeout=30)
+        # Вебхук поднимается вместе с HTTP-сервером в post_init, ждём, пока тот начнёт слушать
+        await asyncio.sleep(0.5)
+
+        started = time.monotonic()
+        for index in range(args.updates):
+            await telegram.push_command(1_000_000 + index, "/start")
+            await asyncio.sleep(max(0.0, started + (index + 1) / args.rate - time.monotonic()))
+        deadline = time.monotonic() + 10
+        while telegram.awaiting_reply and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+    finally:
+        if process.returncode is None:
+            process.send_signal(signal.SIGTERM)
+            try:
+                await asyncio.wait_for(process.wait(), timeout=15)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+        await telegram.stop()
+
+    latencies = telegram.reply_latencies
+    return {
+        "mode": mode,
+        "updates": args.updates,
+        "replied": len(latencies),
+        "latency_p50_ms": percentile(latencies, 0.50) * 1000,
+        "latency_p95_ms": percentile(latencies, 0.95) * 1000,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+        "latency_mean_ms": (statistics.fmean(latencies) if latencies else 0.0) * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Задержка обновление → ответ в режимах polling и webhook")
+    parser.add_argument("--updates", type=int, default=300, help="сколько команд /start отправить")
+    parser.add_argument("--rate", type=float, default=50.0, help="команд в секунду")
+    parser.add_argument("--modes", default="polling,webhook")
+    parser.add_argument("--json", help="куда сохранить отчёт")
+    args = parser.parse_args()
+
+    reports = [asyncio.run(run_mode(mode, args)) for mode in args.modes.split(",")]
+    print(f"{'режим':<10} {'ответов':>8} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9}")
+    for report in reports:
+        print(
+            f"{report['mode']:<10} {report['replied']:>8} {report['latency_p50_ms']:>9.1f} "
+            f"{report['latency_p95_ms']:>9.1f} {report['latency_p99_ms']:>9.1f}"
+        )
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(reports, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# Проверка отзыва быстрых уведомлений об упавшей транзакции (ALERT_MODE=fast).
+#
+# Один чат отслеживает оба кошелька перевода SOL из корпуса. Логи приходят на processed без ошибки,
+# а подтверждённая версия транзакции упала (meta.err). Каждая подписка mentions даёт свой элемент
+# конвейера: первый отправляет быстрое уведомление, второй его не повторяет. После подтверждения
+# быстрое уведомление должно быть удалено, и ни один элемент не должен прислать полное уведомление.
+#
+# Запуск из корня репозитория:
+#     python benchmarks/check_failed_siblings.py [--confirm-delay 1.0]
+import argparse
+import asyncio
+import json
+import os
+import sys
+from urllib.parse import parse_qs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakes  # noqa: E402
+
+CHAT_ID = 42
+
+# Поддельный Telegram, который запоминает тексты отправленных и отредактированных сообщений
+class RecordingTelegram(fakes.FakeTelegram):
+    def __init__(self, clock_source=None):
+        super().__init__(clock_source)
+        self.texts = []  # (метод, текст)
+
+    async def on_http(self, method, path, headers, body):
+        api_method = path.rsplit("/", 1)[-1]
+        if api_method in ("sendMessage", "editMessageText"):
+            if headers.get("content-type", "").startswith("application/json"):
+                params = json.loads(body or b"{}")
+            else:
+                params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+            self.texts.append((api_method, params.get("text", "")))
+        return await super().on_http(method, path, headers, body)
+
+async def run(args):
+    solana = fakes.FakeSolana(confirm_delay=args.confirm_delay)
+    ws_port, http_port = await solana.start()
+    telegram_api = RecordingTelegram(solana)
+    tg_port = await telegram_api.start()
+    os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+    os.environ["SOLANA_WS_URL"] = f"ws://127.0.0.1:{ws_port}"
+    os.environ["SOLANA_HTTP_URL"] = f"http://127.0.0.1:{http_port}"
+    os.environ["PRICE_BACKEND"] = "stub"
+    os.environ["WALLETS_DB_PATH"] = ":memory:"
+    os.environ["INGEST_MODE"] = "logs"
+    os.environ["ALERT_MODE"] = "fast"
+    os.environ["LOG_LEVEL"] = "WARNING"
+
+    import telegram
+    import bot
+
+    tg = telegram.Bot(bot.BOT_TOKEN, base_url=f"http://127.0.0.1:{tg_port}/bot")
+    await tg.initialize()
+    bot.notifier.start(tg)
+    bot.token_cache.start()
+
+    with open(os.path.join(ROOT, "benchmarks", "corpus", "sol_transfer.json"), encoding="utf-8") as f:
+        record = json.load(f)
+    transaction = record["transaction"]
+    keys = [key if isinstance(key, str) else key["pubkey"] for key in transaction["transaction"]["message"]["accountKeys"]]
+    sender = record["wallet"]
+    recipient = next(key for key in keys if key != sender and key != bot.SYSTEM_PROGRAM_ID)
+
+    types = bot.types_mask(["transfer", "receive", "send"])
+    for name, address in (("sender", sender), ("recipient", recipient)):
+        await bot.monitor_wallet(address, CHAT_ID, name, types)
+    deadline = asyncio.get_running_loop().time() + 10
+    while not bot.subscriptions_covered() and asyncio.get_running_loop().time() < deadline:
+        await asyncio.sleep(0.05)
+
+    # Подтверждённая версия упала, а на processed логи пришли без ошибки
+    failed = json.loads(json.dumps(transaction))
+    failed["meta"]["err"] = {"InstructionError": [0, {"Custom": 1}]}
+    solana.transactions[record["signature"]] = failed
+    await solana.publish(record["signature"], failed, 300000000, transaction["meta"].get("logMessages") or ())
+    await asyncio.sleep(args.confirm_delay + 3.0)
+
+    provisional = [text for method, text in telegram_api.texts if method == "sendMessage" and text.startswith("⏳")]
+    full = [text for _, text in telegram_api.texts if not text.startswith("⏳")]
+    print(f"быстрых уведомлений: {len(provisional)}, удалено: {telegram_api.deleted}, полных: {len(full)}")
+    failures = []
+    if not provisional:
+        failures.append("быстрое уведомление не отправлено: сценарий ничего не проверил")
+    if telegram_api.deleted < len(provisional):
+        failures.append("быстрое уведомление об упавшей транзакции не удалено")
+    for text in full:
+        failures.append(f"полное уведомление об упавшей транзакции: {text.splitlines()[0]}")
+
+    await bot.logs_pool.stop()
+    await bot.pipeline.stop()
+    await bot.backfiller.stop()
+    await bot.notifier.stop()
+    await bot.token_cache.stop()
+    await bot.tx_fetcher.close()
+    await tg.shutdown()
+    await solana.stop()
+    await telegram_api.stop()
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Упавшая транзакция не даёт полных уведомлений ни одному кошельку чата")
+    parser.add_argument("--confirm-delay", type=float, default=1.0, help="через сколько секунд после processed транзакция подтверждается")
+    args = parser.parse_args()
+
+    failures = asyncio.run(run(args))
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+    print("OK")
+
+if __name__ == "__main__":
+    main()
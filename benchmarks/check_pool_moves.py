@@ -0,0 +1,120 @@
+# Проверка переноса подписок в пуле logsSubscribe при добавлении и удалении кошельков.
+#
+# Поддельный узел отвечает на подписку с задержкой (--ack-delay), и до ответа подписка не действует.
+# Сценарий сначала заполняет пул, затем удаляет адреса так, что соединения выводятся и их адреса
+# переезжают, потом снова добавляет и удаляет. Всё это время проверяется, что у каждого отслеживаемого
+# адреса, однажды покрытого, на узле есть живая подписка. В конце у каждого адреса должна остаться
+# ровно одна подписка, у удалённых — ни одной, выводимых соединений быть не должно.
+#
+# Запуск из корня репозитория:
+#     python benchmarks/check_pool_moves.py [--ack-delay 0.2]
+import argparse
+import asyncio
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakes  # noqa: E402
+
+# Шаги сценария: ("add" | "remove", индексы адресов)
+SCENARIO = [
+    ("add", range(12)),
+    ("remove", (0, 3, 6, 9, 1, 4, 7)),
+    ("add", range(12, 18)),
+    ("remove", (2, 12, 13, 5)),
+]
+
+async def run(args):
+    solana = fakes.FakeSolana(ack_delay=args.ack_delay)
+    ws_port, http_port = await solana.start()
+    os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+    os.environ["SOLANA_WS_URL"] = f"ws://127.0.0.1:{ws_port}"
+    os.environ["SOLANA_HTTP_URL"] = f"http://127.0.0.1:{http_port}"
+    os.environ["WALLETS_DB_PATH"] = ":memory:"
+    os.environ["INGEST_MODE"] = "logs"
+    os.environ["LOG_LEVEL"] = "WARNING"
+
+    from solders.pubkey import Pubkey
+    import bot
+
+    pool = bot.LogsSubscriptionPool(max_connections=args.max_connections, per_connection=args.per_connection)
+    addresses = [str(Pubkey.new_unique()) for _ in range(max(max(indices) for _, indices in SCENARIO) + 1)]
+    covered = set()  # Адреса, у которых подписка уже появлялась
+    gaps = set()
+    moves = 0
+
+    move = pool.move
+    def counting_move(address, source, target):
+        nonlocal moves
+        moves += 1
+        move(address, source, target)
+    pool.move = counting_move
+
+    async def watch():
+        while True:
+            for address in list(pool.owners):
+                if solana.mentions.get(address):
+                    covered.add(address)
+                elif address in covered:
+                    gaps.add(address)
+            await asyncio.sleep(0.002)
+
+    watcher = asyncio.create_task(watch())
+    settle = args.ack_delay * 4 + 1.0
+    for step, indices in SCENARIO:
+        for index in indices:
+            if step == "add":
+                pool.add_address(addresses[index])
+            else:
+                pool.remove_address(addresses[index])
+                covered.discard(addresses[index])
+        await asyncio.sleep(settle)
+        print(f"{step} {len(indices)}: соединений {len(pool.connections)} {[len(connection.addresses) for connection in pool.connections]}, выводится {len(pool.draining)}")
+    watcher.cancel()
+
+    tracked = set(pool.owners)
+    live = {address: len(subscribers) for address, subscribers in solana.mentions.items()}
+    duplicated = sorted(address for address in tracked if live.get(address, 0) > 1)
+    missing = sorted(address for address in tracked if not live.get(address))
+    leftover = sorted(address for address in live if address not in tracked)
+
+    print(f"переносов: {moves}")
+    print(f"окон без подписки: {len(gaps)}")
+    print(f"подписок у узла: {sum(live.values())} на {len(tracked)} адресов")
+    failures = []
+    if not moves:
+        failures.append("сценарий не вызвал ни одного переноса")
+    if gaps:
+        failures.append(f"адреса оставались без подписки: {', '.join(sorted(gaps))}")
+    if missing:
+        failures.append(f"нет подписки: {', '.join(missing)}")
+    if duplicated:
+        failures.append(f"лишние подписки: {', '.join(duplicated)}")
+    if leftover:
+        failures.append(f"подписки удалённых адресов: {', '.join(leftover)}")
+    if pool.draining:
+        failures.append(f"не закрылись выводимые соединения: {len(pool.draining)}")
+
+    await pool.stop()
+    await solana.stop()
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Перенос подписок пула без окон покрытия и без лишних подписок")
+    parser.add_argument("--ack-delay", type=float, default=0.2, help="задержка ответа узла на подписку, сек")
+    parser.add_argument("--per-connection", type=int, default=3, help="подписок на соединение")
+    parser.add_argument("--max-connections", type=int, default=4)
+    args = parser.parse_args()
+
+    failures = asyncio.run(run(args))
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+    print("OK")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+# Локальные подделки внешних сервисов для нагрузочных тестов:
+# Solana WebSocket + JSON-RPC и Telegram Bot API.
+import asyncio
+import json
+import re
+import time
+from urllib.parse import parse_qs
+
+import httpx
+import websockets
+
+TOKEN_PROGRAM_ID = "TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623DQ5x"
+SYSTEM_PROGRAM_ID = "11111111111111111111111111111111"
+TOKEN_ACCOUNT_SIZE = 165
+SIGNATURE_RE = re.compile(r"solscan\.io/tx/([1-9A-HJ-NP-Za-km-z]+)")
+
+# Минимальный HTTP/1.1 сервер с keep-alive: handler(method, path, body) -> (status, dict)
+async def serve_http(handler, host="127.0.0.1", port=0):
+    async def on_connection(reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, payload = await handler(method, path, headers, body)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\nConnection: keep-alive\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(on_connection, host, port)
+
+def server_port(server):
+    return server.sockets[0].getsockname()[1]
+
+# Адреса, за которыми следит подписка: mentions у logsSubscribe, сам аккаунт у accountSubscribe
+def watched_addresses(method, params):
+    if method == "logsSubscribe":
+        return params[0].get("mentions", ())
+    return params[:1]
+
+# Поддельный узел Solana: подписки по WebSocket и JSON-RPC по HTTP.
+# Транзакция видна на processed сразу, а на confirmed — через confirm_delay: подписчики
+# с commitment confirmed получают уведомление позже, getTransaction до этого отвечает null.
+# ack_delay — задержка ответа на подписку: до ответа подписка не действует, как у загруженного узла
+class FakeSolana:
+    def __init__(self, rpc_latency=0.0, confirm_delay=0.0, ack_delay=0.0):
+        self.rpc_latency = rpc_latency
+        self.confirm_delay = confirm_delay
+        self.ack_delay = ack_delay
+        self.transactions = {}  # signature -> ответ getTransaction
+        self.subscriptions = {}  # subscription_id -> (websocket, method, params)
+        self.mentions = {}  # address -> {subscription_id: websocket} для logsSubscribe
+        self.accounts = {}  # address -> {subscription_id: websocket} для accountSubscribe
+        self.next_subscription = 1
+        self.sent_at = {}  # signature -> time.monotonic() отправки уведомления
+        self.bytes_sent = 0
+        self.rpc_requests = 0
+        self.rpc_calls = {}
+        self.ws_server = None
+        self.http_server = None
+        self.delayed = set()  # Уведомления, ждущие подтверждения
+        self.history = {}  # address -> [(signature, slot, err)] от старых к новым
+
+    async def start(self):
+        self.ws_server = await websockets.serve(self.on_ws, "127.0.0.1", 0, max_size=None)
+        self.http_server = await serve_http(self.on_http)
+        return server_port(self.ws_server), server_port(self.http_server)
+
+    async def stop(self):
+        for task in self.delayed:
+            task.cancel()
+        self.ws_server.close()
+        self.http_server.close()
+
+    async def on_ws(self, websocket):
+        try:
+            async for raw in websocket:
+                request = json.loads(raw)
+                method = request.get("method", "")
+                if method.endswith("Unsubscribe"):
+                    self.drop_subscription(request["params"][0])
+                    result = True
+                else:
+                    if self.ack_delay:
+                        await asyncio.sleep(self.ack_delay)
+                    result = self.next_subscription
+                    self.next_subscription += 1
+                    params = request.get("params", [])
+                    self.subscriptions[result] = (websocket, method, params)
+                    index = self.address_index(method)
+                    if index is not None:
+                        for address in watched_addresses(method, params):
+                            index.setdefault(address, {})[result] = websocket
+                await websocket.send(json.dumps({"jsonrpc": "2.0", "result": result, "id": request.get("id")}))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for subscription_id, (ws, _, _) in list(self.subscriptions.items()):
+                if ws is websocket:
+                    self.drop_subscription(subscription_id)
+
+    def drop_subscription(self, subscription_id):
+        subscription = self.subscriptions.pop(subscription_id, None)
+        index = self.address_index(subscription[1]) if subscription is not None else None
+        if index is None:
+            return
+        for address in watched_addresses(subscription[1], subscription[2]):
+            subscribers = index.get(address, {})
+            subscribers.pop(subscription_id, None)
+            if not subscribers:
+                index.pop(address, None)
+
+    # Подписки на конкретные адреса индексируются, чтобы публикация не перебирала все подписки
+    def address_index(self, method):
+        return {"logsSubscribe": self.mentions, "accountSubscribe": self.accounts}.get(method)
+
+    def subscribers(self, method, first_param=None):
+        for subscription_id, (websocket, sub_method, params) in list(self.subscriptions.items()):
+            if sub_method == method and (first_param is None or (params and params[0] == first_param)):
+                yield subscription_id, websocket
+
+    async def send(self, websocket, message):
+        self.bytes_sent += len(message)
+        try:
+            await websocket.send(message)
+        except websockets.ConnectionClosed:
+            pass
+
+    # Подписчики processed получают уведомление сразу, остальные — после подтверждения
+    async def deliver(self, subscription_id, websocket, message):
+        subscription = self.subscriptions.get(subscription_id)
+        params = subscription[2] if subscription is not None else []
+        commitment = params[1].get("commitment") if len(params) > 1 and isinstance(params[1], dict) else None
+        if commitment == "processed" or not self.confirm_delay:
+            await self.send(websocket, message)
+            return
+        task = asyncio.create_task(self.deliver_later(websocket, message))
+        self.delayed.add(task)
+        task.add_done_callback(self.delayed.discard)
+
+    async def deliver_later(self, websocket, message):
+        await asyncio.sleep(self.confirm_delay)
+        await self.send(websocket, message)
+
+    def confirmed(self, signature):
+        sent_at = self.sent_at.get(signature)
+        return sent_at is None or time.monotonic() - sent_at >= self.confirm_delay
+
+    # Публикация транзакции, как её видит узел: изменённые токен-аккаунты уходят подписчикам
+    # programSubscribe на SPL Token (jsonParsed, без подписи), изменённые аккаунты — подписчикам
+    # accountSubscribe, а подпись и логи — logsSubscribe тех адресов, что упомянуты в транзакции
+    async def publish(self, signature, transaction, slot, logs=()):
+        self.sent_at[signature] = time.monotonic()
+        meta = transaction.get("meta") or {}
+        keys = [key if isinstance(key, str) else key.get("pubkey") for key in transaction["transaction"]["message"]["accountKeys"]]
+        for address in keys:
+            self.history.setdefault(address, []).append((signature, slot, meta.get("err")))
+
+        for balance in meta.get("postTokenBalances") or ():
+            account = {
+                "pubkey": keys[balance["accountIndex"]],
+                "account": {
+                    "data": {"program": "spl-token", "space": TOKEN_ACCOUNT_SIZE, "parsed": {"type": "account", "info": {
+                        "isNative": False, "mint": balance["mint"], "owner": balance.get("owner"),
+                        "state": "initialized", "tokenAmount": balance["uiTokenAmount"],
+                    }}},
+                    "executable": False, "lamports": 2039280, "owner": TOKEN_PROGRAM_ID, "rentEpoch": 18446744073709551615, "space": TOKEN_ACCOUNT_SIZE,
+                },
+            }
+            for subscription_id, websocket in self.subscribers("programSubscribe", TOKEN_PROGRAM_ID):
+                await self.deliver(subscription_id, websocket, json.dumps({
+                    "jsonrpc": "2.0", "method": "programNotification",
+                    "params": {"subscription": subscription_id, "result": {"context": {"slot": slot}, "value": account}},
+                }))
+
+        for index, address in enumerate(keys):
+            for subscription_id, websocket in list(self.accounts.get(address, {}).items()):
+                lamports = (meta.get("postBalances") or [0] * len(keys))[index]
+                await self.deliver(subscription_id, websocket, json.dumps({
+                    "jsonrpc": "2.0", "method": "accountNotification",
+                    "params": {"subscription": subscription_id, "result": {"context": {"slot": slot}, "value": {
+                        "data": ["", "base64"], "executable": False, "lamports": lamports,
+                        "owner": SYSTEM_PROGRAM_ID, "rentEpoch": 18446744073709551615, "space": 0,
+                    }}},
+                }))
+
+        # Логи — взгляд на processed: падение подтверждённой версии видно только в getTransaction
+        for address in keys:
+            for subscription_id, websocket in list(self.mentions.get(address, {}).items()):
+                await self.deliver(subscription_id, websocket, json.dumps({
+                    "jsonrpc": "2.0", "method": "logsNotification",
+                    "params": {"subscription": subscription_id, "result": {
+                        "context": {"slot": slot}, "value": {"signature": signature, "err": None, "logs": list(logs)},
+                    }},
+                }))
+
+    # getSignaturesForAddress: от новых к старым, только подтверждённые, с before/until/limit
+    def signatures_for_address(self, address, options):
+        before, until = options.get("before"), options.get("until")
+        result = []
+        for signature, slot, err in reversed(self.history.get(address, ())):
+            if not self.confirmed(signature):
+                continue
+            if before is not None:
+                if signature == before:
+                    before = None
+                continue
+            if signature == until or len(result) >= options.get("limit", 1000):
+                break
+            result.append({"signature": signature, "slot": slot, "err": err, "memo": None, "blockTime": None, "confirmationStatus": "confirmed"})
+        return result
+
+    async def on_http(self, method, path, headers, body):
+        self.rpc_requests += 1
+        if self.rpc_latency:
+            await asyncio.sleep(self.rpc_latency)
+        request = json.loads(body)
+        if isinstance(request, list):
+            return 200, [self.rpc_call(item) for item in request]
+        return 200, self.rpc_call(request)
+
+    def rpc_call(self, request):
+        method = request.get("method")
+        params = request.get("params") or []
+        self.rpc_calls[method] = self.rpc_calls.get(method, 0) + 1
+        if method == "getTransaction":
+            result = self.transactions.get(params[0]) if self.confirmed(params[0]) else None
+        elif method == "getMultipleAccounts":
+            result = {"context": {"slot": 0}, "value": [None] * len(params[0])}
+        elif method == "getSignaturesForAddress":
+            result = self.signatures_for_address(params[0], params[1] if len(params) > 1 else {})
+        else:
+            result = None
+        return {"jsonrpc": "2.0", "id": request.get("id"), "result": result}
+
+# Поддельный Telegram Bot API: принимает sendMessage и считает задержку доставки уведомлений,
+# отдаёт обновления через getUpdates или вебхук и считает задержку от обновления до ответа
+class FakeTelegram:
+    def __init__(self, clock_source=None):
+        self.clock_source = clock_source  # FakeSolana: откуда брать время отправки уведомления
+        self.latencies = []  # сек, от уведомления WebSocket до sendMessage
+        self.edit_latencies = []  # сек, от уведомления WebSocket до editMessageText (подтверждение быстрого уведомления)
+        self.deleted = 0  # deleteMessage: отозванные быстрые уведомления
+        self.messages = 0
+        self.next_message_id = 1
+        self.server = None
+        self.updates = []  # Ещё не забранные getUpdates обновления
+        self.updates_available = asyncio.Event()
+        self.next_update_id = 1
+        self.webhook = None  # (url, secret) после setWebhook
+        self.webhook_client = None
+        self.awaiting_reply = {}  # chat_id -> время отправки обновления
+        self.reply_latencies = []  # сек, от обновления до первого ответа в этот чат
+        self.ready = asyncio.Event()  # Бот начал забирать обновления (getUpdates или setWebhook)
+
+    async def start(self):
+        self.server = await serve_http(self.on_http)
+        return server_port(self.server)
+
+    async def stop(self):
+        self.server.close()
+        if self.webhook_client is not None:
+            await self.webhook_client.aclose()
+
+    # Команда от пользователя chat_id: уходит боту вебхуком или ждёт getUpdates
+    async def push_command(self, chat_id, text):
+        update = {
+            "update_id": self.next_update_id,
+            "message": {
+                "message_id": self.next_update_id, "date": int(time.time()), "text": text,
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}] if text.startswith("/") else [],
+            },
+        }
+        self.next_update_id += 1
+        self.awaiting_reply[chat_id] = time.monotonic()
+        if self.webhook is not None:
+            url, secret = self.webhook
+            await self.webhook_client.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": secret or ""})
+        else:
+            self.updates.append(update)
+            self.updates_available.set()
+
+    async def get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates:
+            self.updates_available.clear()
+            try:
+                await asyncio.wait_for(self.updates_available.wait(), timeout=float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return list(self.updates)
+
+    def on_reply(self, chat_id):
+        sent_at = self.awaiting_reply.pop(chat_id, None)
+        if sent_at is not None:
+            self.reply_latencies.append(time.monotonic() - sent_at)
+
+    async def on_http(self, method, path, headers, body):
+        api_method = path.rsplit("/", 1)[-1]
+        if headers.get("content-type", "").startswith("application/json"):
+            params = json.loads(body or b"{}")
+        else:
+            params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+        if api_method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}}
+        if api_method == "getUpdates":
+            self.ready.set()
+            return 200, {"ok": True, "result": await self.get_updates(params)}
+        if api_method == "setWebhook":
+            self.webhook = (params["url"], params.get("secret_token"))
+            if self.webhook_client is None:
+                self.webhook_client = httpx.AsyncClient(timeout=30.0)
+            self.ready.set()
+            return 200, {"ok": True, "result": True}
+        if api_method == "deleteWebhook":
+            self.webhook = None
+            return 200, {"ok": True, "result": True}
+        if api_method == "deleteMessage":
+            self.deleted += 1
+            return 200, {"ok": True, "result": True}
+        if api_method in ("sendMessage", "editMessageText"):
+            now = time.monotonic()
+            text = params.get("text", "")
+            latencies = self.latencies if api_method == "sendMessage" else self.edit_latencies
+            if self.clock_source is not None:
+                for signature in SIGNATURE_RE.findall(text):
+                    sent_at = self.clock_source.sent_at.get(signature)
+                    if sent_at is not None:
+                        latencies.append(now - sent_at)
+            self.messages += 1
+            message_id = int(params.get("message_id") or self.next_message_id)
+            self.next_message_id += 1
+            chat_id = int(str(params.get("chat_id", 0)).strip('"'))
+            self.on_reply(chat_id)
+            return 200, {"ok": True, "result": {
+                "message_id": message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": text,
+            }}
+        return 200, {"ok": True, "result": True}
@@ -0,0 +1,67 @@
+# Запись реального трафика для bench_pipeline.py: подписи транзакций с участием
+# отслеживаемых программ (logsSubscribe) и ответы getTransaction к ним.
+#
+# Запуск из корня репозитория:
+#     python benchmarks/record.py --count 500 --out recorded.jsonl
+import argparse
+import asyncio
+import json
+import os
+
+import httpx
+import websockets
+
+PROGRAM_IDS = [
+    "TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623DQ5x",
+    "JUP6LkbZbjS1jKKwapdHNy74zcZ3tLUZoi5QNyVTp1",
+    "6EF8rrecthR5DkcocFusWxY6dvdTQXThK6JVZSJ1C1",
+    "675kPX9MHTjS2zt1qfr1NYHuzeLXfQM9H24wFSUt1Mp8",
+]
+
+async def record(ws_url, http_url, program_id, count, out):
+    async with websockets.connect(ws_url, max_size=None) as ws, httpx.AsyncClient(timeout=30) as session:
+        await ws.send(json.dumps({
+            "jsonrpc": "2.0", "id": 1, "method": "logsSubscribe",
+            "params": [{"mentions": [program_id]}, {"commitment": "confirmed"}],
+        }))
+        await ws.recv()
+        written = 0
+        async for raw in ws:
+            value = json.loads(raw).get("params", {}).get("result", {}).get("value", {})
+            signature = value.get("signature")
+            if not signature or value.get("err"):
+                continue
+            response = await session.post(http_url, json={
+                "jsonrpc": "2.0", "id": 1, "method": "getTransaction",
+                "params": [signature, {"encoding": "jsonParsed", "commitment": "confirmed", "maxSupportedTransactionVersion": 0}],
+            })
+            tx = response.json().get("result")
+            if not tx:
+                continue
+            keys = tx["transaction"]["message"]["accountKeys"]
+            wallet = keys[0]["pubkey"] if isinstance(keys[0], dict) else keys[0]
+            out.write(json.dumps({
+                "program": program_id,
+                "wallet": wallet,
+                "signature": signature,
+                "transaction": tx,
+            }) + "\n")
+            written += 1
+            if written >= count:
+                return
+
+async def main():
+    parser = argparse.ArgumentParser(description="Запись уведомлений и транзакций для нагрузочного теста")
+    parser.add_argument("--count", type=int, default=100, help="транзакций на каждую программу")
+    parser.add_argument("--out", default="recorded.jsonl")
+    args = parser.parse_args()
+
+    ws_url = os.getenv("SOLANA_WS_URL", "wss://api.mainnet-beta.solana.com")
+    http_url = os.getenv("SOLANA_HTTP_URL", "https://api.mainnet-beta.solana.com")
+    with open(args.out, "w", encoding="utf-8") as out:
+        for program_id in PROGRAM_IDS:
+            await record(ws_url, http_url, program_id, args.count, out)
+            print(f"{program_id}: записано {args.count}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
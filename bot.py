@@ -2,22 +2,28 @@ import telegram
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler
 from telegram.ext import filters  # Новый модуль фильтров
-import requests
+from telegram.error import RetryAfter, BadRequest, Forbidden, NetworkError
 import time
 import logging
 import os
 import random
-import http.server
-import socketserver
-from solana.rpc.websocket_api import connect
-from solana.rpc.api import Client
+import signal
 from solders.pubkey import Pubkey  # Импортируем Pubkey
 import json
+import sqlite3
+import websockets
+import httpx
+import msgspec
 from base64 import b64decode
 import asyncio
+import bisect
+import hashlib
+import sys
+from collections import OrderedDict, deque
+from typing import Any
 
 # Настройка логирования
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # Твой Telegram Bot токен из переменной окружения
@@ -26,264 +32,2679 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не установлен в переменных окружения!")
 
-# Фиктивный HTTP-сервер для Render
+# HTTP-сервер с метриками, проверкой здоровья и вебхуком Telegram (Render требует, чтобы порт был открыт)
 PORT = int(os.getenv("PORT", 8443))  # Render использует переменную PORT, по умолчанию 8443
 
-def start_dummy_server():
-    Handler = http.server.SimpleHTTPRequestHandler
-    with socketserver.TCPServer(("", PORT), Handler) as httpd:
-        logger.info(f"Фиктивный сервер запущен на порту {PORT}")
-        httpd.serve_forever()
+# Приём обновлений Telegram: polling (getUpdates) или webhook на том же PORT
+TELEGRAM_MODE = os.getenv("TELEGRAM_MODE", "polling")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")  # Можно указать свой Bot API сервер
+TELEGRAM_UPDATE_CONCURRENCY = int(os.getenv("TELEGRAM_UPDATE_CONCURRENCY", 32))  # Обновлений, обрабатываемых одновременно
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL")  # Публичный адрес сервиса
+WEBHOOK_PATH = "/telegram/webhook"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
 
-# Запускаем фиктивный сервер в отдельном потоке
-dummy_server_thread = asyncio.get_event_loop().run_in_executor(None, start_dummy_server)
+if TELEGRAM_MODE not in ("polling", "webhook"):
+    raise ValueError(f"TELEGRAM_MODE должен быть polling или webhook, получено {TELEGRAM_MODE!r}")
+if TELEGRAM_MODE == "webhook" and not WEBHOOK_URL:
+    raise ValueError("Для TELEGRAM_MODE=webhook нужен WEBHOOK_URL (или RENDER_EXTERNAL_URL)")
 
-# Словарь для хранения кошельков с синхронизацией
+# Метрики в формате Prometheus: счётчики и гистограммы с метками
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metrics:
+    def __init__(self):
+        self.help = {}  # name -> (type, описание)
+        self.counters = {}  # (name, labels) -> значение
+        self.histograms = {}  # (name, labels) -> [счётчики по корзинам..., сумма, количество]
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    # gauges: [(name, labels, value)] — мгновенные значения, которые считает вызывающий;
+    # counters и histograms: [((name, labels), значение)] — метрики других процессов (шардов)
+    def render(self, gauges=(), counters=(), histograms=()):
+        lines = []
+        described = set()
+
+        def header(name):
+            if name in described or name not in self.help:
+                return
+            described.add(name)
+            kind, text = self.help[name]
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted([*self.counters.items(), *counters]):
+            header(name)
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), histogram in sorted([*self.histograms.items(), *histograms]):
+            header(name)
+            for bound, count in zip(LATENCY_BUCKETS, histogram):
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {count}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram[-1]}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram[-2]}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram[-1]}")
+        # Строки одной метрики должны идти подряд: свои и шардовые значения перемешаны
+        for name, labels, value in sorted(gauges, key=lambda gauge: gauge[0]):
+            header(name)
+            lines.append(f"{name}{format_labels(tuple(sorted(labels.items())))} {value}")
+        return "\n".join(lines) + "\n"
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels) + "}"
+
+metrics = Metrics()
+metrics.describe("dtracker_notifications_total", "counter", "Уведомления WebSocket по стадиям: received, filtered, matched")
+metrics.describe("dtracker_rpc_request_seconds", "histogram", "Длительность HTTP-запросов к Solana RPC")
+metrics.describe("dtracker_rpc_rate_limited_total", "counter", "Ответы 429 от Solana RPC")
+metrics.describe("dtracker_active_subscriptions", "gauge", "Активные подписки по программам")
+metrics.describe("dtracker_telegram_queue_depth", "gauge", "Сообщения в очереди отправки Telegram")
+metrics.describe("dtracker_telegram_sent_total", "counter", "Отправленные сообщения Telegram")
+metrics.describe("dtracker_telegram_retries_total", "counter", "Повторы отправки в Telegram (RetryAfter и сетевые ошибки)")
+metrics.describe("dtracker_telegram_digests_total", "counter", "Сводки из склеенных уведомлений")
+metrics.describe("dtracker_event_loop_lag_seconds", "gauge", "Последняя измеренная задержка event loop")
+metrics.describe("dtracker_event_loop_lag_max_seconds", "gauge", "Максимальная задержка event loop с момента старта")
+metrics.describe("dtracker_wallet_last_seen_slot", "gauge", "Слот последней транзакции адреса")
+metrics.describe("dtracker_tracked_wallets", "gauge", "Подписки чатов на кошельки")
+metrics.describe("dtracker_tracked_addresses", "gauge", "Уникальные адреса под мониторингом")
+metrics.describe("dtracker_telegram_updates_total", "counter", "Обновления Telegram, принятые вебхуком")
+metrics.describe("dtracker_logs_connections", "gauge", "Открытые соединения пула logsSubscribe")
+metrics.describe("dtracker_account_connections", "gauge", "Открытые соединения пула accountSubscribe")
+
+# Словарь для хранения кошельков с синхронизацией: (chat_id, name) -> {"address", "chat_id", "name", "types"}.
+# Имя уникально только внутри чата; types — битовая маска выбранных типов (types_mask)
 tracked_wallets = {}
 wallet_lock = asyncio.Lock()  # Для синхронизации доступа к tracked_wallets
+last_seen = {}  # address -> [last_tx, last_slot]: точка отсчёта догрузки общая для всех подписчиков адреса
 
 # Временное хранилище для состояния
 user_states = {}
 
-# Курс SOL в USD (для теста, нужно получать через API, например, CoinGecko)
+# Курс SOL в USD по умолчанию, пока кэш цен не получил реальный курс
 SOL_TO_USD = 137.0  # Пример: 1 SOL = 137 USD (как на скриншоте)
 
 # Solana WebSocket клиент
-SOLANA_WS_URL = "wss://api.mainnet-beta.solana.com"
-SOLANA_HTTP_URL = "https://api.mainnet-beta.solana.com"
-solana_client = Client(SOLANA_HTTP_URL)
+SOLANA_WS_URL = os.getenv("SOLANA_WS_URL", "wss://api.mainnet-beta.solana.com")
+SOLANA_HTTP_URL = os.getenv("SOLANA_HTTP_URL", "https://api.mainnet-beta.solana.com")
 
 # Программы для отслеживания (в виде строк, которые потом преобразуем в Pubkey)
 SPL_TOKEN_PROGRAM_ID = "TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623DQ5x"  # SPL Token Program
 JUPITER_PROGRAM_ID = "JUP6LkbZbjS1jKKwapdHNy74zcZ3tLUZoi5QNyVTp1"  # Jupiter Aggregator
 PUMP_FUN_PROGRAM_ID = "6EF8rrecthR5DkcocFusWxY6dvdTQXThK6JVZSJ1C1"  # Pump Fun
 RAYDIUM_PROGRAM_ID = "675kPX9MHTjS2zt1qfr1NYHuzeLXfQM9H24wFSUt1Mp8"  # Raydium
+SYSTEM_PROGRAM_ID = "11111111111111111111111111111111"  # System Program (переводы SOL)
+TOKEN_2022_PROGRAM_ID = "TokenzQdBNbLqP5VEhdkAS6EPFLC1PHnBqCXEpPxuEb"  # Token-2022
+WSOL_MINT = "So11111111111111111111111111111111111111112"  # Wrapped SOL
+LAMPORTS_PER_SOL = 1_000_000_000
+
+# Типизированное декодирование JSON: из сообщений WebSocket и ответов RPC берём только нужные поля,
+# остальное msgspec пропускает, не создавая Python-объектов. Program ID и ключи аккаунтов интернируются:
+# повторяющиеся строки хранятся один раз, а поиск по словарям сравнивает указатели.
+
+class ParsedInstruction(msgspec.Struct):
+    type: str = ""
+
+class Instruction(msgspec.Struct, rename="camel"):
+    program_id: str = ""
+    parsed: ParsedInstruction | str | None = None  # Строкой приходит, например, Memo
+
+    def __post_init__(self):
+        self.program_id = sys.intern(self.program_id)
+
+class InnerInstructions(msgspec.Struct):
+    instructions: list[Instruction] = []
+
+# В jsonParsed ключ аккаунта — объект {"pubkey": ...}, в других кодировках — строка
+class AccountKey(msgspec.Struct):
+    pubkey: str = ""
+
+def intern_keys(keys):
+    return [sys.intern(key if isinstance(key, str) else key.pubkey) for key in keys]
+
+class TxMessage(msgspec.Struct, rename="camel"):
+    account_keys: list[str | AccountKey] = []  # После декодирования — только строки
+    instructions: list[Instruction] = []
+
+    def __post_init__(self):
+        self.account_keys = intern_keys(self.account_keys)
+
+class TransactionBody(msgspec.Struct):
+    message: TxMessage = msgspec.field(default_factory=TxMessage)
+
+class UiTokenAmount(msgspec.Struct):
+    amount: str = "0"
+    decimals: int = 0
+
+class TokenBalance(msgspec.Struct, rename="camel"):
+    mint: str = ""
+    owner: str | None = None
+    ui_token_amount: UiTokenAmount | None = None
+
+class TransactionMeta(msgspec.Struct, rename="camel"):
+    err: Any = None
+    fee: int = 0
+    pre_balances: list[int] = []
+    post_balances: list[int] = []
+    pre_token_balances: list[TokenBalance] | None = None
+    post_token_balances: list[TokenBalance] | None = None
+    inner_instructions: list[InnerInstructions] | None = None
+
+# Результат getTransaction (jsonParsed): только то, что читает классификатор
+class Transaction(msgspec.Struct):
+    slot: int = 0
+    meta: TransactionMeta | None = None
+    transaction: TransactionBody = msgspec.field(default_factory=TransactionBody)
+
+# Элемент ответа getSignaturesForAddress
+class SignatureInfo(msgspec.Struct):
+    signature: str = ""
+    slot: int | None = None
+    err: Any = None
+
+# Ответ JSON-RPC: result декодируется позже, декодером конкретного метода
+class RpcResponse(msgspec.Struct):
+    id: int | None = None
+    result: msgspec.Raw = msgspec.Raw(b"null")
+    error: Any = None
+
+# Сообщения WebSocket: ответы на подписку и уведомления program/logs/account
+class SubscriptionReply(msgspec.Struct):
+    id: int | None = None
+    result: Any = None
+    error: Any = None
+
+class NotificationContext(msgspec.Struct):
+    slot: int | None = None
+
+# Уведомление программы — изменённый аккаунт (pubkey, account), подписи транзакции в нём нет.
+# Из jsonParsed-данных токен-аккаунта нужен только владелец; прочие аккаунты приходят как [base64, "base64"]
+class TokenAccountInfo(msgspec.Struct):
+    owner: str = ""
+
+class ParsedAccount(msgspec.Struct):
+    info: TokenAccountInfo = msgspec.field(default_factory=TokenAccountInfo)
+
+class AccountData(msgspec.Struct):
+    parsed: ParsedAccount | None = None
+
+class ProgramAccount(msgspec.Struct):
+    data: AccountData | list | None = None
+
+class ProgramValue(msgspec.Struct):
+    pubkey: str = ""
+    account: ProgramAccount = msgspec.field(default_factory=ProgramAccount)
+
+class ProgramResult(msgspec.Struct):
+    context: NotificationContext = msgspec.field(default_factory=NotificationContext)
+    value: ProgramValue = msgspec.field(default_factory=ProgramValue)
+
+class ProgramParams(msgspec.Struct):
+    subscription: int | None = None
+    result: ProgramResult | None = None
+
+class ProgramWsMessage(msgspec.Struct):
+    id: int | None = None
+    result: Any = None
+    error: Any = None
+    method: str = ""
+    params: ProgramParams | None = None
+
+class LogsValue(msgspec.Struct):
+    signature: str = ""
+    err: Any = None
+    logs: msgspec.Raw = msgspec.Raw(b"[]")  # Разбираются только для быстрых уведомлений (logs_decoder)
+
+class LogsResult(msgspec.Struct):
+    context: NotificationContext = msgspec.field(default_factory=NotificationContext)
+    value: LogsValue = msgspec.field(default_factory=LogsValue)
+
+class LogsParams(msgspec.Struct):
+    subscription: int | None = None
+    result: LogsResult | None = None
+
+class LogsWsMessage(msgspec.Struct):
+    id: int | None = None
+    result: Any = None
+    error: Any = None
+    method: str = ""
+    params: LogsParams | None = None
+
+# Из уведомления аккаунта нужен только факт изменения: данные аккаунта пропускаем
+class AccountResult(msgspec.Struct):
+    context: NotificationContext = msgspec.field(default_factory=NotificationContext)
+
+class AccountParams(msgspec.Struct):
+    subscription: int | None = None
+    result: AccountResult | None = None
+
+class AccountWsMessage(msgspec.Struct):
+    id: int | None = None
+    result: Any = None
+    error: Any = None
+    method: str = ""
+    params: AccountParams | None = None
+
+json_decoder = msgspec.json.Decoder()
+transaction_decoder = msgspec.json.Decoder(Transaction | None)
+signatures_decoder = msgspec.json.Decoder(list[SignatureInfo] | None)
+rpc_response_decoder = msgspec.json.Decoder(list[RpcResponse] | RpcResponse)
+subscription_reply_decoder = msgspec.json.Decoder(SubscriptionReply | list[SubscriptionReply])
+program_message_decoder = msgspec.json.Decoder(ProgramWsMessage)
+logs_message_decoder = msgspec.json.Decoder(LogsWsMessage)
+account_message_decoder = msgspec.json.Decoder(AccountWsMessage)
+logs_decoder = msgspec.json.Decoder(list[str] | None)
+
+# Транзакция из JSON getTransaction (result) — для корпуса, бенчмарков и записей
+def decode_transaction(data):
+    return transaction_decoder.decode(data)
+
+# Параметры получения транзакций по RPC
+RPC_BATCH_SIZE = int(os.getenv("RPC_BATCH_SIZE", 20))  # Максимум запросов в одном JSON-RPC батче
+RPC_BATCH_WINDOW = float(os.getenv("RPC_BATCH_WINDOW", 0.02))  # Сколько секунд копим запросы перед отправкой
+RPC_MAX_IN_FLIGHT = int(os.getenv("RPC_MAX_IN_FLIGHT", 4))  # Одновременных HTTP-запросов к RPC
+RPC_MAX_RETRIES = 5  # Попыток при 429 Too Many Requests
+RPC_BACKOFF_BASE = 0.5  # Начальная задержка между попытками, сек
+RPC_BACKOFF_MAX = 8.0
+
+# Асинхронный клиент Solana JSON-RPC: общий keep-alive пул, батчи и повторы при 429
+class TransactionFetcher:
+    def __init__(self, url, batch_size=RPC_BATCH_SIZE, batch_window=RPC_BATCH_WINDOW, max_in_flight=RPC_MAX_IN_FLIGHT):
+        self.url = url
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.max_in_flight = max_in_flight
+        self.session = None
+        self.semaphore = None
+        self.pending = []  # [(method, params, decoder, future)]
+        self.flush_handle = None
+        self.batch_tasks = set()
+
+    def get_session(self):
+        # Сессия создаётся лениво, внутри работающего event loop
+        if self.session is None:
+            self.session = httpx.AsyncClient(
+                timeout=httpx.Timeout(30.0, connect=10.0),
+                limits=httpx.Limits(
+                    max_connections=self.max_in_flight,
+                    max_keepalive_connections=self.max_in_flight,
+                    keepalive_expiry=60.0,
+                ),
+            )
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.aclose()
+            self.session = None
+
+    # Ставим вызов в очередь текущего батча и ждём его результат (decoder разбирает result)
+    async def request(self, method, params, decoder=json_decoder):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((method, params, decoder, future))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.batch_window, self.flush)
+        return await future
+
+    async def get_transaction(self, signature, commitment="confirmed"):
+        return await self.request("getTransaction", [
+            signature,
+            {"encoding": "jsonParsed", "commitment": commitment, "maxSupportedTransactionVersion": 0},
+        ], transaction_decoder)
 
-# Подписка на транзакции через WebSocket (для программ)
-async def monitor_program_ws(address, name, types, chat_id, program_id, bot):
-    async with connect(SOLANA_WS_URL) as ws:
-        # Даём задержку для инициализации WebSocket
-        await asyncio.sleep(5)
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.create_task(self.send_batch(batch))
+            self.batch_tasks.add(task)
+            task.add_done_callback(self.batch_tasks.discard)
 
-        # Преобразуем program_id в Pubkey
+    async def send_batch(self, batch):
+        payload = [
+            {"jsonrpc": "2.0", "id": i, "method": method, "params": params}
+            for i, (method, params, _, _) in enumerate(batch)
+        ]
         try:
-            logger.info(f"Попытка преобразования program_id: {program_id}")
-            program_pubkey = Pubkey.from_string(program_id)
-            logger.info(f"Успешно преобразовано program_id {program_id} в Pubkey: {program_pubkey}")
+            responses = await self.post(payload)
         except Exception as e:
-            logger.error(f"Ошибка преобразования program_id {program_id} в Pubkey: {str(e)}")
+            logger.error(f"Ошибка RPC-батча из {len(batch)} запросов: {str(e)}")
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
             return
 
-        # Подписываемся на транзакции программы
-        await ws.program_subscribe(program_pubkey)
-        first_resp = await ws.recv()
+        if isinstance(responses, RpcResponse):
+            responses = [responses]
+        by_id = {resp.id: resp for resp in responses}
+        for i, (method, params, decoder, future) in enumerate(batch):
+            if future.done():
+                continue
+            resp = by_id.get(i)
+            if resp is None:
+                future.set_result(None)
+                continue
+            if resp.error is not None:
+                logger.warning(f"RPC {method} вернул ошибку: {resp.error}")
+            try:
+                future.set_result(decoder.decode(resp.result))
+            except msgspec.ValidationError as e:
+                logger.error(f"Неожиданный ответ RPC {method}: {str(e)}")
+                future.set_exception(e)
+
+    async def post(self, payload):
+        session = self.get_session()
+        delay = RPC_BACKOFF_BASE
+        for attempt in range(RPC_MAX_RETRIES):
+            async with self.semaphore:
+                started = time.monotonic()
+                response = await session.post(self.url, json=payload)
+                metrics.observe("dtracker_rpc_request_seconds", time.monotonic() - started)
+            if response.status_code != 429:
+                response.raise_for_status()
+                return rpc_response_decoder.decode(response.content)
+            metrics.inc("dtracker_rpc_rate_limited_total")
+            # Уважаем Retry-After, иначе экспоненциальная задержка с джиттером
+            retry_after = response.headers.get("Retry-After")
+            wait = float(retry_after) if retry_after else delay * random.uniform(0.5, 1.5)
+            logger.warning(f"RPC ответил 429, попытка {attempt + 1}/{RPC_MAX_RETRIES}, ждём {wait:.2f} с")
+            await asyncio.sleep(wait)
+            delay = min(delay * 2, RPC_BACKOFF_MAX)
+        raise RuntimeError(f"RPC перегружен: {RPC_MAX_RETRIES} ответов 429 подряд")
+
+tx_fetcher = TransactionFetcher(SOLANA_HTTP_URL)
+
+# Параметры общего кэша подписей
+SIGNATURE_CACHE_SIZE = int(os.getenv("SIGNATURE_CACHE_SIZE", 20000))  # Максимум подписей в кэше
+SIGNATURE_CACHE_TTL = float(os.getenv("SIGNATURE_CACHE_TTL", 600))  # Время жизни записи, сек
+
+class SignatureCacheEntry:
+    __slots__ = ("expires_at", "future", "notified_chats", "seen_wallets", "provisional")
+
+    def __init__(self, expires_at):
+        self.expires_at = expires_at
+        self.future = None  # Текущий (или завершённый) запрос getTransaction
+        self.notified_chats = set()
+        self.seen_wallets = set()  # Подписки (chat_id, name), по которым подпись уже взята в обработку
+        self.provisional = None  # chat_id -> future отправки быстрого уведомления, которое ждёт правки
+
+# Общий для всех мониторов кэш подписей с TTL и LRU-вытеснением.
+# Одна подпись приходит через несколько подписок сразу: кэш гарантирует
+# один getTransaction на подпись и одно уведомление на пару (подпись, чат).
+class SignatureCache:
+    def __init__(self, fetcher, max_size=SIGNATURE_CACHE_SIZE, ttl=SIGNATURE_CACHE_TTL):
+        self.fetcher = fetcher
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # signature -> SignatureCacheEntry
+        self.hits = 0
+        self.misses = 0
+
+    def entry(self, signature):
+        now = time.monotonic()
+        entry = self.entries.get(signature)
+        if entry is not None and entry.expires_at < now:
+            del self.entries[signature]
+            entry = None
+        if entry is None:
+            entry = SignatureCacheEntry(now + self.ttl)
+            self.entries[signature] = entry
+            # Вытесняем самые давно использованные записи
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(signature)
+        return entry
+
+    # Детали транзакции: параллельные запросы одной подписи ждут один и тот же fetch
+    async def get_transaction(self, signature):
+        entry = self.entry(signature)
+        if entry.future is None:
+            self.misses += 1
+            entry.future = asyncio.ensure_future(self.fetcher.get_transaction(signature))
+            # Ошибку уже залогировал fetcher; ждущих могли отменить, не шумим "exception was never retrieved"
+            entry.future.add_done_callback(lambda future: future.cancelled() or future.exception())
+        else:
+            self.hits += 1
+        future = entry.future
+        try:
+            tx = await asyncio.shield(future)
+        except Exception:
+            # Ошибку не кэшируем: следующий монитор попробует ещё раз
+            if entry.future is future:
+                entry.future = None
+            raise
+        if not tx and entry.future is future:
+            # Свежая транзакция могла ещё не появиться в RPC, пустой ответ тоже не кэшируем
+            entry.future = None
+        return tx
+
+    # True, если уведомление о подписи в этот чат ещё не отправлялось
+    def claim(self, signature, chat_id):
+        notified_chats = self.entry(signature).notified_chats
+        if chat_id in notified_chats:
+            return False
+        notified_chats.add(chat_id)
+        return True
+
+signature_cache = SignatureCache(tx_fetcher)
+
+# Лимиты Telegram Bot API
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30))  # Сообщений в секунду на всего бота
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 1))  # Сообщений в секунду в один чат
+TELEGRAM_CHAT_BURST = 3  # Сколько сообщений можно отправить в чат подряд без паузы
+TELEGRAM_MAX_MESSAGE_LEN = 4096
+DIGEST_THRESHOLD = int(os.getenv("DIGEST_THRESHOLD", 3))  # С какой очереди уведомлений в чате склеиваем их в сводку
+SEND_MAX_RETRIES = 5  # Попыток при сетевых ошибках
+
+# Приоритеты очередей: ответы интерфейса обгоняют уведомления
+PRIORITY_UI = 0
+PRIORITY_ALERT = 1
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Через сколько секунд появится токен (0, если уже есть)
+    def delay(self, now):
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+class OutgoingMessage:
+    __slots__ = ("chat_id", "text", "parse_mode", "reply_markup", "priority", "futures", "attempts", "message_id")
+
+    def __init__(self, chat_id, text, parse_mode, reply_markup, priority, future, message_id=None):
+        self.chat_id = chat_id
+        self.text = text  # None вместе с message_id — удалить сообщение
+        self.parse_mode = parse_mode
+        self.reply_markup = reply_markup
+        self.priority = priority
+        self.futures = [future] if future is not None else []
+        self.attempts = 0
+        self.message_id = message_id  # Правка уже отправленного сообщения вместо нового
+
+    # В сводку склеиваются только новые уведомления, которых никто не ждёт
+    def mergeable(self):
+        return self.message_id is None and not self.futures
+
+class ChatQueue:
+    __slots__ = ("bucket", "lanes", "blocked_until", "busy")
+
+    def __init__(self):
+        self.bucket = TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+        self.lanes = (deque(), deque())  # Индекс = приоритет
+        self.blocked_until = 0.0  # До какого момента чат под RetryAfter
+        self.busy = False  # В чат уже идёт отправка, порядок сообщений сохраняем
 
-        # Проверяем, является ли first_resp списком
-        logger.info(f"Получен ответ от WebSocket: {first_resp}")
-        if isinstance(first_resp, list) and len(first_resp) > 0:
-            subscription_id = first_resp[0].result
+    def pending(self):
+        return len(self.lanes[PRIORITY_UI]) + len(self.lanes[PRIORITY_ALERT])
+
+# Планировщик исходящих сообщений: глобальный и початовый token bucket,
+# приоритетные очереди, повторы при 429 и склейка отставших уведомлений в сводку
+class NotificationScheduler:
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE):
+        self.bot = None
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chats = {}  # chat_id -> ChatQueue
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.send_tasks = set()
+        self.follow_up_tasks = set()  # Ждут отправки быстрого уведомления, чтобы его поправить
+        self.sent = 0
+        self.retries = 0
+        self.digests = 0
+
+    def start(self, bot):
+        self.bot = bot
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        for task in self.follow_up_tasks:
+            task.cancel()
+
+    def depth(self):
+        return sum(chat.pending() for chat in self.chats.values())
+
+    def push(self, message, front=False):
+        chat = self.chats.get(message.chat_id)
+        if chat is None:
+            chat = self.chats[message.chat_id] = ChatQueue()
+        lane = chat.lanes[message.priority]
+        if front:
+            lane.appendleft(message)
         else:
-            subscription_id = first_resp.result
+            lane.append(message)
+        self.wakeup.set()
+
+    # Уведомление: ставим в очередь и не ждём доставки. Возвращает False, если чат его уже получил
+    # signature: одно уведомление на пару (подпись, чат), даже если его прислали несколько шардов
+    # provisional: быстрое уведомление, которое потом правит confirm_alert или удаляет retract_alert
+    def send_alert(self, chat_id, text, parse_mode=None, signature=None, provisional=False):
+        if signature is not None and not signature_cache.claim(signature, chat_id):
+            return False
+        future = None
+        if provisional:
+            future = asyncio.get_running_loop().create_future()
+            future.add_done_callback(lambda future: future.cancelled() or future.exception())
+            entry = signature_cache.entry(signature)
+            if entry.provisional is None:
+                entry.provisional = {}
+            entry.provisional[chat_id] = future
+            metrics.inc("dtracker_fast_alerts_total", outcome="announced")
+        self.push(OutgoingMessage(chat_id, text, parse_mode, None, PRIORITY_ALERT, future))
+        return True
 
-        logger.info(f"Подписка на программу {program_id} для кошелька {name} ({address}) успешна, ID подписки: {subscription_id}")
+    def pop_provisional(self, chat_id, signature):
+        provisional = signature_cache.entry(signature).provisional
+        return provisional.pop(chat_id, None) if provisional else None
 
-        error_notified = False  # Флаг для отслеживания ошибок
+    # Подтверждение: правим быстрое уведомление; если его в этом чате не было — обычное уведомление
+    def confirm_alert(self, chat_id, text, parse_mode=None, signature=None):
+        future = self.pop_provisional(chat_id, signature)
+        if future is None:
+            self.send_alert(chat_id, text, parse_mode, signature)
+            return
+        metrics.inc("dtracker_fast_alerts_total", outcome="confirmed")
+        self.follow_up(future, chat_id, text, parse_mode)
+
+    # Отзыв: транзакция не прошла или не подтвердилась — удаляем быстрое уведомление
+    def retract_alert(self, chat_id, signature):
+        future = self.pop_provisional(chat_id, signature)
+        if future is None:
+            return
+        # Чат снова свободен для уведомления об этой подписи через другой кошелёк
+        signature_cache.entry(signature).notified_chats.discard(chat_id)
+        metrics.inc("dtracker_fast_alerts_total", outcome="retracted")
+        self.follow_up(future, chat_id, None, None)
+
+    def follow_up(self, future, chat_id, text, parse_mode):
+        task = asyncio.create_task(self.run_follow_up(future, chat_id, text, parse_mode))
+        self.follow_up_tasks.add(task)
+        task.add_done_callback(self.follow_up_tasks.discard)
+
+    async def run_follow_up(self, future, chat_id, text, parse_mode):
         try:
-            async for msg in ws:
-                # Парсим сообщение от WebSocket
+            sent = await future
+        except Exception:
+            sent = None
+        if sent is None:
+            # Быстрое уведомление не дошло: подтверждение отправляем новым сообщением, отзывать нечего
+            if text is not None:
+                self.push(OutgoingMessage(chat_id, text, parse_mode, None, PRIORITY_ALERT, None))
+            return
+        self.push(OutgoingMessage(chat_id, text, parse_mode, None, PRIORITY_ALERT, None, message_id=sent.message_id))
+
+    # Ответ интерфейса: идёт вне очереди уведомлений, ждём отправки
+    async def send_reply(self, chat_id, text, reply_markup=None, parse_mode=None):
+        future = asyncio.get_running_loop().create_future()
+        self.push(OutgoingMessage(chat_id, text, parse_mode, reply_markup, PRIORITY_UI, future))
+        return await future
+
+    # Выбираем чат для следующей отправки: сначала UI, затем самые нагруженные чаты
+    def pick(self, now):
+        best = None
+        best_key = None
+        wait = None
+        for chat in self.chats.values():
+            if chat.busy or not chat.pending():
+                continue
+            chat_wait = max(chat.blocked_until - now, chat.bucket.delay(now))
+            if chat_wait > 0:
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+                continue
+            key = (0 if chat.lanes[PRIORITY_UI] else 1, -chat.pending())
+            if best_key is None or key < best_key:
+                best, best_key = chat, key
+        return best, wait
+
+    # Снимаем сообщение с очереди чата; отставшие уведомления склеиваем в одну сводку
+    def take(self, chat):
+        if chat.lanes[PRIORITY_UI]:
+            return chat.lanes[PRIORITY_UI].popleft()
+        lane = chat.lanes[PRIORITY_ALERT]
+        message = lane.popleft()
+        if len(lane) + 1 < DIGEST_THRESHOLD or not message.mergeable():
+            return message
+        parts = [message]
+        length = len(message.text)
+        while lane and lane[0].mergeable() and lane[0].parse_mode == message.parse_mode and length + len(lane[0].text) + 2 < TELEGRAM_MAX_MESSAGE_LEN - 64:
+            parts.append(lane.popleft())
+            length += len(parts[-1].text) + 2
+        if len(parts) == 1:
+            return message
+        self.digests += 1
+        digest = OutgoingMessage(
+            message.chat_id,
+            f"📦 Сводка: {len(parts)} уведомлений\n\n" + "\n\n".join(part.text for part in parts),
+            message.parse_mode, None, PRIORITY_ALERT, None,
+        )
+        for part in parts:
+            digest.futures.extend(part.futures)
+        return digest
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            now = time.monotonic()
+            chat, wait = self.pick(now)
+            if chat is None:
+                # Ждём новое сообщение или освобождения лимита ближайшего чата
                 try:
-                    data = msg.result
-                    if not data:
-                        if not error_notified:
-                            await bot.send_message(chat_id=chat_id, text=f"Кошелек {name} ({address}) неактивен или не имеет транзакций для программы {program_id}.")
-                            error_notified = True
-                        continue
-
-                    # Проверяем, связана ли транзакция с нашим кошельком
-                    accounts = data.get("value", {}).get("transaction", {}).get("message", {}).get("accountKeys", [])
-                    if address not in accounts:
-                        continue
-
-                    signature = data.get("value", {}).get("signature")
-                    if not signature:
-                        continue
-
-                    logger.info(f"Новая транзакция для {name} через программу {program_id}: {signature}")
-
-                    # Используем Solana JSON-RPC для получения деталей транзакции
-                    tx_response = solana_client.get_transaction(signature, encoding="jsonParsed")
-                    if not tx_response["result"]:
-                        if not error_notified:
-                            await bot.send_message(chat_id=chat_id, text=f"Не удалось получить детали транзакции {signature} для кошелька {name}.")
-                            error_notified = True
-                        continue
-
-                    tx = tx_response["result"]
-                    tx_type = classify_transaction(tx)
-                    if tx_type in types:
-                        # Упрощенные данные о транзакции (нужен API для точных данных)
-                        sol_amount = tx.get("meta", {}).get("fee", 0) / 1_000_000_000  # Лампорты в SOL (используем fee как пример)
-                        usd_amount = sol_amount * SOL_TO_USD
-                        token_amount = random.uniform(5000000, 10000000)  # Пример
-                        token_name = "NYCPR"  # Нужно получать через API
-                        token_price = 0.000037  # Пример
-                        market_cap = "300.4K"  # Пример
-
-                        msg = (
-                            f"#{name.upper()}\n"
-                            f"Swapped {sol_amount:.2f} #SOL (${usd_amount:,.2f}) for {token_amount:,.2f} #{token_name} @ ${token_price}\n"
-                            f"MC: ${market_cap}\n"
-                            f"#Solana | [ViewTx](https://solscan.io/tx/{signature}) | [Chart](https://www.dextools.io/app/en/solana)\n"
-                            f"👉 Купить можно тут: https://gmgn.ai/?ref=HiDMfJX4&chain=sol\n"
-                            f"👉 Купить через Bloom: https://t.me/BloomSolana_bot?start=ref_57Z29YIQ2J"
-                        )
-                        await bot.send_message(chat_id=chat_id, text=msg, parse_mode='Markdown')
-                        logger.info(f"Уведомление отправлено для {name}: {tx_type}")
-                except Exception as e:
-                    logger.error(f"Ошибка обработки транзакции для {name} (программа {program_id}): {str(e)}")
-                    if not error_notified:
-                        await bot.send_message(chat_id=chat_id, text=f"Ошибка мониторинга {name} (программа {program_id}): {str(e)}")
-                        error_notified = True
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            global_wait = self.global_bucket.delay(now)
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+                continue
+
+            now = time.monotonic()
+            self.global_bucket.take(now)
+            chat.bucket.take(now)
+            chat.busy = True
+            task = asyncio.create_task(self.deliver(chat, self.take(chat)))
+            self.send_tasks.add(task)
+            task.add_done_callback(self.send_tasks.discard)
+
+    async def deliver(self, chat, message):
+        try:
+            if message.message_id is None:
+                result = await self.bot.send_message(
+                    chat_id=message.chat_id, text=message.text,
+                    parse_mode=message.parse_mode, reply_markup=message.reply_markup,
+                )
+            elif message.text is None:
+                result = await self.bot.delete_message(chat_id=message.chat_id, message_id=message.message_id)
+            else:
+                result = await self.bot.edit_message_text(
+                    text=message.text, chat_id=message.chat_id, message_id=message.message_id,
+                    parse_mode=message.parse_mode,
+                )
+            self.sent += 1
+            for future in message.futures:
+                if not future.done():
+                    future.set_result(result)
+        except RetryAfter as e:
+            # Telegram сказал подождать: блокируем чат и возвращаем сообщение в начало очереди
+            self.retries += 1
+            logger.warning(f"Flood control для чата {message.chat_id}, повтор через {e.retry_after} с")
+            chat.blocked_until = time.monotonic() + float(e.retry_after)
+            self.push(message, front=True)
+        except (BadRequest, Forbidden) as e:
+            logger.error(f"Не удалось отправить сообщение в чат {message.chat_id}: {str(e)}")
+            self.fail(message, e)
+        except NetworkError as e:
+            message.attempts += 1
+            if message.attempts >= SEND_MAX_RETRIES:
+                logger.error(f"Сообщение в чат {message.chat_id} не доставлено после {message.attempts} попыток: {str(e)}")
+                self.fail(message, e)
+            else:
+                self.retries += 1
+                chat.blocked_until = time.monotonic() + min(2 ** message.attempts, 30)
+                self.push(message, front=True)
+        except Exception as e:
+            logger.error(f"Ошибка отправки сообщения в чат {message.chat_id}: {str(e)}")
+            self.fail(message, e)
         finally:
-            # Отписываемся при завершении
-            await ws.program_unsubscribe(subscription_id)
+            chat.busy = False
+            self.wakeup.set()
+
+    def fail(self, message, error):
+        for future in message.futures:
+            if not future.done():
+                future.set_exception(error)
+
+notifier = NotificationScheduler()
+
+# Постоянное хранилище кошельков
+WALLETS_DB_PATH = os.getenv("WALLETS_DB_PATH", "wallets.db")
+CHECKPOINT_FLUSH_INTERVAL = 5.0  # Как часто сбрасываем last_tx в базу, сек
+RESTORE_BATCH_SIZE = int(os.getenv("RESTORE_BATCH_SIZE", 100))  # Кошельков в одной пачке при восстановлении
+RESTORE_BATCH_DELAY = float(os.getenv("RESTORE_BATCH_DELAY", 0.2))  # Пауза между пачками, сек
+RESTORE_COVERAGE_TIMEOUT = 60.0  # Сколько ждём подтверждения всех подписок после старта
 
-# Подписка на изменения аккаунта (для прямых операций с SOL)
-async def monitor_account_ws(address, name, types, chat_id, bot):
-    async with connect(SOLANA_WS_URL) as ws:
-        # Даём задержку для инициализации WebSocket
-        await asyncio.sleep(5)
+# Реестр кошельков в SQLite (WAL): переживает перезапуски и редеплои.
+# Подписки чатов (subscriptions) и точки отсчёта догрузки по адресам (addresses) хранятся раздельно.
+# Запросы короткие и локальные, поэтому выполняются прямо в event loop.
+class WalletRegistry:
+    def __init__(self, path=WALLETS_DB_PATH):
+        self.path = path
+        self.conn = None
+        self.checkpoints = {}  # address -> last_tx, ещё не записанные в базу
+        self.flush_task = None
 
-        # Преобразуем address в Pubkey
+    def open(self):
+        if self.conn is not None:
+            return
+        self.conn = sqlite3.connect(self.path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS subscriptions ("
+            "chat_id INTEGER NOT NULL, "
+            "name TEXT NOT NULL, "
+            "address TEXT NOT NULL, "
+            "types INTEGER NOT NULL, "
+            "updated_at REAL NOT NULL, "
+            "PRIMARY KEY (chat_id, name))"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS addresses ("
+            "address TEXT PRIMARY KEY, "
+            "last_tx TEXT, "
+            "updated_at REAL NOT NULL)"
+        )
+        self.migrate()
+
+    # Прежняя схема: одна таблица wallets с глобальным именем и списком типов в JSON
+    def migrate(self):
+        if self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'wallets'").fetchone() is None:
+            return
+        rows = self.conn.execute("SELECT name, address, chat_id, types, last_tx, updated_at FROM wallets").fetchall()
+        self.conn.execute("BEGIN")
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO subscriptions (chat_id, name, address, types, updated_at) VALUES (?, ?, ?, ?, ?)",
+            [(chat_id, name, address, types_mask(json.loads(types)), updated_at) for name, address, chat_id, types, _, updated_at in rows],
+        )
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO addresses (address, last_tx, updated_at) VALUES (?, ?, ?)",
+            [(address, last_tx, updated_at) for _, address, _, _, last_tx, updated_at in rows if last_tx],
+        )
+        self.conn.execute("DROP TABLE wallets")
+        self.conn.execute("COMMIT")
+        logger.info(f"Реестр {self.path} переведён на подписки по чатам: {len(rows)} кошельков")
+
+    def close(self):
+        if self.conn is None:
+            return
+        self.flush()
+        self.conn.close()
+        self.conn = None
+
+    def load(self):
+        self.open()
+        wallets = {}
+        for chat_id, name, address, types in self.conn.execute(
+            "SELECT chat_id, name, address, types FROM subscriptions"
+        ):
+            wallets[(chat_id, name)] = {"address": address, "chat_id": chat_id, "name": name, "types": types}
+        return wallets
+
+    # Последние подписи по адресам: address -> last_tx
+    def load_checkpoints(self):
+        self.open()
+        return dict(self.conn.execute("SELECT address, last_tx FROM addresses WHERE last_tx IS NOT NULL"))
+
+    def save(self, wallet):
+        self.open()
+        self.conn.execute(
+            "INSERT INTO subscriptions (chat_id, name, address, types, updated_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(chat_id, name) DO UPDATE SET address = excluded.address, "
+            "types = excluded.types, updated_at = excluded.updated_at",
+            (wallet["chat_id"], wallet["name"], wallet["address"], wallet["types"], time.time()),
+        )
+
+    # last_tx меняется на каждой транзакции: копим и пишем пачкой
+    def checkpoint(self, address, signature):
+        self.checkpoints[address] = signature
+
+    def flush(self):
+        if not self.checkpoints or self.conn is None:
+            return
+        checkpoints, self.checkpoints = self.checkpoints, {}
+        now = time.time()
+        self.conn.execute("BEGIN")
+        self.conn.executemany(
+            "INSERT INTO addresses (address, last_tx, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(address) DO UPDATE SET last_tx = excluded.last_tx, updated_at = excluded.updated_at",
+            [(address, signature, now) for address, signature in checkpoints.items()],
+        )
+        self.conn.execute("COMMIT")
+
+    def start(self):
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.run_flush())
+
+    async def stop(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        self.close()
+
+    async def run_flush(self):
+        while True:
+            await asyncio.sleep(CHECKPOINT_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи last_tx в {self.path}: {str(e)}")
+
+wallet_registry = WalletRegistry()
+
+# Кэш цен и метаданных токенов
+PRICE_BACKEND = os.getenv("PRICE_BACKEND", "jupiter")  # jupiter или stub (локальные данные без сети)
+PRICE_API_URL = os.getenv("PRICE_API_URL", "https://api.jup.ag/price/v2")
+TOKEN_PRICE_TTL = float(os.getenv("TOKEN_PRICE_TTL", 30))  # Через сколько секунд цена считается устаревшей
+TOKEN_METADATA_TTL = 600.0  # Supply и символ меняются редко
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 5000))
+TOKEN_REFRESH_INTERVAL = 2.0  # Период фонового обновления, сек
+TOKEN_REFRESH_BATCH = 100  # Лимит getMultipleAccounts и ids у Jupiter
+METADATA_PROGRAM_ID = "metaqbxxUerdq28cj1RbAWkYQm3ybzjb6a8bt518x1s"  # Metaplex Token Metadata
+
+class TokenInfo:
+    __slots__ = ("mint", "symbol", "decimals", "supply", "price", "market_cap", "price_updated", "metadata_updated")
+
+    def __init__(self, mint):
+        self.mint = mint
+        self.symbol = None
+        self.decimals = None
+        self.supply = None  # В единицах токена (с учётом decimals)
+        self.price = None  # USD
+        self.market_cap = None  # USD
+        self.price_updated = 0.0
+        self.metadata_updated = 0.0
+
+# Адрес аккаунта метаданных Metaplex для mint
+def metadata_address(mint):
+    program = Pubkey.from_string(METADATA_PROGRAM_ID)
+    address, _ = Pubkey.find_program_address([b"metadata", bytes(program), bytes(Pubkey.from_string(mint))], program)
+    return str(address)
+
+# Символ из аккаунта Metaplex: key(1) + update_authority(32) + mint(32) + name + symbol (borsh-строки)
+def parse_metadata_symbol(data):
+    offset = 65
+    name_len = int.from_bytes(data[offset:offset + 4], "little")
+    offset += 4 + name_len
+    symbol_len = int.from_bytes(data[offset:offset + 4], "little")
+    symbol = data[offset + 4:offset + 4 + symbol_len].decode("utf-8", "ignore").rstrip("\x00").strip()
+    return symbol or None
+
+# Метаданные токенов с RPC: decimals и supply из mint-аккаунтов, символ из Metaplex, всё батчами getMultipleAccounts
+class RpcMetadataSource:
+    def __init__(self, fetcher):
+        self.fetcher = fetcher
+
+    async def fetch_metadata(self, mints):
+        metadata = {}
+        result = await self.fetcher.request("getMultipleAccounts", [mints, {"encoding": "jsonParsed"}])
+        for mint, account in zip(mints, (result or {}).get("value") or ()):
+            data = (account or {}).get("data")
+            info = data.get("parsed", {}).get("info", {}) if isinstance(data, dict) else {}
+            if "decimals" not in info:
+                continue
+            metadata[mint] = {"decimals": info["decimals"], "supply": int(info.get("supply", 0)) / 10 ** info["decimals"], "symbol": None}
+
+        if metadata:
+            found = list(metadata)
+            result = await self.fetcher.request("getMultipleAccounts", [[metadata_address(mint) for mint in found], {"encoding": "base64"}])
+            for mint, account in zip(found, (result or {}).get("value") or ()):
+                if not account:
+                    continue
+                try:
+                    metadata[mint]["symbol"] = parse_metadata_symbol(b64decode(account["data"][0]))
+                except Exception as e:
+                    logger.warning(f"Не удалось разобрать метаданные токена {mint}: {str(e)}")
+        return metadata
+
+# Цены в USD из Jupiter Price API
+class JupiterPriceSource:
+    def __init__(self, url=PRICE_API_URL):
+        self.url = url
+        self.session = None
+
+    async def fetch_prices(self, mints):
+        if self.session is None:
+            self.session = httpx.AsyncClient(timeout=httpx.Timeout(10.0))
+        response = await self.session.get(self.url, params={"ids": ",".join(mints)})
+        response.raise_for_status()
+        prices = {}
+        for mint, item in (response.json().get("data") or {}).items():
+            if item and item.get("price") is not None:
+                prices[mint] = float(item["price"])
+        return prices
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.aclose()
+            self.session = None
+
+# Локальный источник без сети: для тестов и бенчмарков
+class StubTokenSource:
+    def __init__(self, tokens=None, prices=None):
+        self.tokens = tokens or {}  # mint -> {"symbol", "decimals", "supply"}
+        self.prices = prices or {}  # mint -> USD
+
+    async def fetch_metadata(self, mints):
+        return {mint: self.tokens[mint] for mint in mints if mint in self.tokens}
+
+    async def fetch_prices(self, mints):
+        return {mint: self.prices[mint] for mint in mints if mint in self.prices}
+
+    async def close(self):
+        pass
+
+# Кэш цен и метаданных по mint. Отрисовка уведомлений читает только из памяти,
+# а недостающие и устаревшие записи обновляются в фоне пачками.
+class TokenInfoCache:
+    def __init__(self, metadata_source, price_source, max_size=TOKEN_CACHE_SIZE):
+        self.metadata_source = metadata_source
+        self.price_source = price_source
+        self.max_size = max_size
+        self.tokens = OrderedDict()  # mint -> TokenInfo
+        self.wanted = set()  # mint, которые нужно обновить
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    # Без сетевых вызовов: если данных нет или они устарели, ставим mint в очередь обновления
+    def get(self, mint):
+        info = self.tokens.get(mint)
+        now = time.monotonic()
+        if info is None or now - info.price_updated > TOKEN_PRICE_TTL:
+            self.wanted.add(mint)
+            self.wakeup.set()
+        if info is not None:
+            self.tokens.move_to_end(mint)
+        return info
+
+    def sol_price(self):
+        info = self.get(WSOL_MINT)
+        return info.price if info is not None and info.price else SOL_TO_USD
+
+    def entry(self, mint):
+        info = self.tokens.get(mint)
+        if info is None:
+            info = self.tokens[mint] = TokenInfo(mint)
+            while len(self.tokens) > self.max_size:
+                self.tokens.popitem(last=False)
+        return info
+
+    def start(self):
+        self.wanted.add(WSOL_MINT)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.price_source.close()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=TOKEN_REFRESH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            # Небольшая пауза, чтобы собрать в пачку mint из нескольких уведомлений
+            await asyncio.sleep(0.05)
+            self.wakeup.clear()
+            while self.wanted:
+                batch = [self.wanted.pop() for _ in range(min(TOKEN_REFRESH_BATCH, len(self.wanted)))]
+                try:
+                    await self.refresh(batch)
+                except Exception as e:
+                    logger.error(f"Ошибка обновления данных {len(batch)} токенов: {str(e)}")
+
+    async def refresh(self, mints):
+        now = time.monotonic()
+        stale = [mint for mint in mints if mint != WSOL_MINT and now - self.entry(mint).metadata_updated > TOKEN_METADATA_TTL]
+        fetches = [self.price_source.fetch_prices(mints)]
+        if stale:
+            fetches.append(self.metadata_source.fetch_metadata(stale))
+        results = await asyncio.gather(*fetches)
+        prices = results[0]
+        metadata = results[1] if stale else {}
+        for mint, meta in metadata.items():
+            info = self.entry(mint)
+            info.decimals = meta["decimals"]
+            info.supply = meta["supply"]
+            info.symbol = meta.get("symbol") or info.symbol
+            info.metadata_updated = now
+        for mint in mints:
+            info = self.entry(mint)
+            info.price_updated = now  # Даже без цены не спрашиваем этот mint до истечения TTL
+            if mint in prices:
+                info.price = prices[mint]
+                if info.supply is not None:
+                    info.market_cap = info.price * info.supply
+
+def make_token_cache():
+    if PRICE_BACKEND == "stub":
+        stub = StubTokenSource(prices={WSOL_MINT: SOL_TO_USD})
+        return TokenInfoCache(stub, stub)
+    return TokenInfoCache(RpcMetadataSource(tx_fetcher), JupiterPriceSource())
+
+token_cache = make_token_cache()
+
+# Контроль задержки event loop: насколько позже запланированного просыпается корутина
+EVENT_LOOP_LAG_INTERVAL = 0.5  # Период замера, сек
+EVENT_LOOP_LAG_WARNING = 0.5  # С какой задержки пишем предупреждение в лог, сек
+
+class EventLoopLagMonitor:
+    def __init__(self, interval=EVENT_LOOP_LAG_INTERVAL, history=1000):
+        self.interval = interval
+        self.samples = deque(maxlen=history)  # Последние замеры, сек
+        self.max_lag = 0.0
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - started - self.interval)
+            self.samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag > EVENT_LOOP_LAG_WARNING:
+                logger.warning(f"Event loop задержан на {lag:.2f} с")
+
+    def last(self):
+        return self.samples[-1] if self.samples else 0.0
+
+loop_lag_monitor = EventLoopLagMonitor()
+
+# Программы, на которые держим общие подписки. Кошелёк виден только в токен-аккаунтах SPL Token
+# (владелец в jsonParsed); свапы Jupiter, Pump Fun и Raydium всегда меняют токен-аккаунты кошелька,
+# а аккаунты самих DEX-программ (пулы, кривые) владельца-кошелька не содержат
+PROGRAM_IDS = [SPL_TOKEN_PROGRAM_ID]
+TOKEN_ACCOUNT_SIZE = 165  # Размер токен-аккаунта: фильтр dataSize отсекает минты и мультисиги
+
+# Короткое имя токена, пока нет метаданных
+def short_mint(mint):
+    return f"{mint[:4]}…{mint[-4:]}" if mint else "?"
+
+# Цена токена без экспоненты: мемкоины стоят доли цента
+def format_price(price):
+    if price >= 1:
+        return f"{price:,.2f}"
+    return f"{price:.10f}".rstrip("0").rstrip(".") or "0"
+
+# Компактная запись больших сумм: 300.4K, 1.2M
+def format_compact(value):
+    for threshold, suffix in ((1e9, "B"), (1e6, "M"), (1e3, "K")):
+        if value >= threshold:
+            return f"{value / threshold:.1f}{suffix}"
+    return f"{value:.0f}"
+
+# Формирование текста уведомления о транзакции (только из кэша, без сетевых вызовов)
+def format_alert(name, signature, classification):
+    sol_amount = abs(classification.sol_change)
+    usd_amount = sol_amount * token_cache.sol_price()
+    token_amount = abs(classification.token_change)
+    token = token_cache.get(classification.token_mint) if classification.token_mint else None
+    token_name = (token.symbol if token is not None and token.symbol else None) or short_mint(classification.token_mint)
+    if token is not None and token.price:
+        token_price = token.price
+    else:
+        token_price = usd_amount / token_amount if token_amount else 0.0
+    market_cap = f"MC: ${format_compact(token.market_cap)}\n" if token is not None and token.market_cap else ""
+
+    if classification.tx_type == "swap_sell":
+        action = f"Swapped {token_amount:,.2f} #{token_name} for {sol_amount:.2f} #SOL (${usd_amount:,.2f}) @ ${format_price(token_price)}"
+    elif classification.tx_type in ("swap", "swap_buy"):
+        action = f"Swapped {sol_amount:.2f} #SOL (${usd_amount:,.2f}) for {token_amount:,.2f} #{token_name} @ ${format_price(token_price)}"
+    elif classification.token_mint:
+        action = f"{classification.tx_type}: {classification.token_change:+,.2f} #{token_name}, {classification.sol_change:+.4f} #SOL"
+    else:
+        action = f"{classification.tx_type}: {classification.sol_change:+.4f} #SOL (${usd_amount:,.2f})"
+
+    return (
+        f"#{name.upper()}\n"
+        f"{action}\n"
+        f"{market_cap}"
+        f"#Solana | [ViewTx](https://solscan.io/tx/{signature}) | [Chart](https://www.dextools.io/app/en/solana)\n"
+        f"👉 Купить можно тут: https://gmgn.ai/?ref=HiDMfJX4&chain=sol\n"
+        f"👉 Купить через Bloom: https://t.me/BloomSolana_bot?start=ref_57Z29YIQ2J"
+    )
+
+# Быстрое уведомление: тип известен только по логам, сумм ещё нет
+def format_provisional(name, signature, tx_type):
+    return (
+        f"⏳ #{name.upper()}\n"
+        f"{TX_TYPE_LABELS.get(tx_type, 'Transaction')}: ждём подтверждения\n"
+        f"#Solana | [ViewTx](https://solscan.io/tx/{signature})"
+    )
+
+# Разовое сообщение об ошибке для кошелька (дальше молчим, как и раньше)
+def notify_wallet_error(wallet, text):
+    if wallet.error_notified:
+        return
+    wallet.error_notified = True
+    notifier.send_alert(wallet.chat_id, text)
+
+# Запоминаем последнюю увиденную транзакцию адреса (в памяти и в реестре)
+def record_last_tx(address, signature, slot=None):
+    seen = last_seen.get(address)
+    if seen is None:
+        seen = last_seen[address] = [None, None]
+    elif seen[0] == signature:
+        return
+    # Воркеры fetch и пачки догрузки завершаются не по порядку: точку отсчёта двигаем только вперёд,
+    # иначе следующая догрузка перелистает старую историю
+    elif slot is not None and seen[1] is not None and slot < seen[1]:
+        return
+    seen[0] = signature
+    if slot is not None:
+        seen[1] = slot
+    wallet_registry.checkpoint(address, signature)
+
+# Параметры переподключения подписок
+WS_PING_INTERVAL = 20  # Пинг WebSocket, сек
+WS_PING_TIMEOUT = 20  # Без ответа на пинг столько секунд считаем соединение мёртвым
+PROGRAM_IDLE_TIMEOUT = float(os.getenv("PROGRAM_IDLE_TIMEOUT", 60))  # Поток программы не молчит так долго, если жив
+RECONNECT_BACKOFF_BASE = 1.0  # Первая пауза перед переподключением, сек
+RECONNECT_BACKOFF_MAX = 60.0
+RECONNECT_STABLE_PERIOD = 60.0  # Проработав столько, подписка снова начинает с короткой паузы
+
+metrics.describe("dtracker_reconnects_total", "counter", "Переподключения подписок")
+metrics.describe("dtracker_backfilled_signatures_total", "counter", "Подписи, найденные при догрузке пропусков")
+
+def ws_connect():
+    return websockets.connect(SOLANA_WS_URL, max_size=None, ping_interval=WS_PING_INTERVAL, ping_timeout=WS_PING_TIMEOUT)
+
+# Ответ на подписку: объект или список из одного объекта
+async def read_subscription_id(ws):
+    reply = subscription_reply_decoder.decode(await ws.recv())
+    if isinstance(reply, list):
+        reply = reply[0] if reply else SubscriptionReply()
+    if reply.result is None:
+        raise RuntimeError(f"подписка отклонена: {reply.error}")
+    return reply.result
+
+# Надзор за подпиской: перезапуск с экспоненциальной паузой и джиттером.
+# run(reconnected) получает True на каждом запуске после первого, чтобы догрузить пропуски.
+async def supervise(label, kind, run):
+    delay = RECONNECT_BACKOFF_BASE
+    reconnected = False
+    while True:
+        started = time.monotonic()
         try:
-            logger.info(f"Попытка преобразования address: {address}")
-            address_pubkey = Pubkey.from_string(address)
-            logger.info(f"Успешно преобразовано address {address} в Pubkey: {address_pubkey}")
+            await run(reconnected)
+            logger.warning(f"Подписка {label} завершилась, переподключаемся")
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logger.error(f"Ошибка преобразования address {address} в Pubkey: {str(e)}")
+            logger.error(f"Подписка {label} упала: {str(e)}")
+        metrics.inc("dtracker_reconnects_total", kind=kind)
+        if time.monotonic() - started > RECONNECT_STABLE_PERIOD:
+            delay = RECONNECT_BACKOFF_BASE
+        await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+        delay = min(delay * 2, RECONNECT_BACKOFF_MAX)
+        reconnected = True
+
+# Параметры конвейера уведомлений
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 1000))  # Ёмкость очереди перед каждой стадией
+PIPELINE_FETCH_WORKERS = int(os.getenv("PIPELINE_FETCH_WORKERS", 16))  # Одновременных getTransaction (склеиваются в батчи)
+PIPELINE_OVERLOAD_POLICY = os.getenv("PIPELINE_OVERLOAD_POLICY", "drop_unknown")  # drop_unknown, sample или drop_newest
+PIPELINE_SHED_WATERMARK = float(os.getenv("PIPELINE_SHED_WATERMARK", 0.5))  # С какой заполненности очередей начинаем сбрасывать
+PIPELINE_SAMPLE_RATE = float(os.getenv("PIPELINE_SAMPLE_RATE", 0.25))  # Доля транзакций, пропускаемых политикой sample
+PIPELINE_DELIVER_HIGH_WATER = int(os.getenv("PIPELINE_DELIVER_HIGH_WATER", 2000))  # Глубина очереди Telegram, выше которой доставка ждёт
+
+# Порядок сброса для drop_unknown: чем выше нагрузка, тем больше типов отбрасываем, свапы — последними
+SHED_ORDER = ("unknown", "approvals", "receive", "send", "wrap", "transfer", "contract_creation", "nft_mint")
+
+if PIPELINE_OVERLOAD_POLICY not in ("drop_unknown", "sample", "drop_newest"):
+    raise ValueError(f"PIPELINE_OVERLOAD_POLICY должен быть drop_unknown, sample или drop_newest, получено {PIPELINE_OVERLOAD_POLICY!r}")
+
+metrics.describe("dtracker_pipeline_queue_depth", "gauge", "Элементы в очереди перед стадией конвейера")
+metrics.describe("dtracker_pipeline_shed_total", "counter", "Сброшенные при перегрузке транзакции и уведомления")
+metrics.describe("dtracker_pipeline_processed_total", "counter", "Элементы, прошедшие стадию конвейера")
+
+class PipelineItem:
+    __slots__ = ("signature", "wallets", "slot", "source", "tx", "alerts", "logs", "announced", "attempts", "deadline")
+
+    def __init__(self, signature, wallets, slot, source, logs=None):
+        self.signature = signature
+        self.wallets = wallets  # Совпавшие подписчики хаба (Subscriber)
+        self.slot = slot
+        self.source = source  # Откуда пришла подпись, для логов
+        self.tx = None
+        self.alerts = []  # (wallet, classification), после render — (wallet, classification, text)
+        self.logs = logs  # Сырые логи processed-уведомления (msgspec.Raw) в режиме ALERT_MODE=fast
+        self.announced = set()  # Чаты, получившие быстрое уведомление от этого элемента
+        self.attempts = 0  # Повторы getTransaction в ожидании подтверждения
+        self.deadline = 0.0  # До какого момента ждём подтверждения processed-транзакции
+
+# Конвейер ingest → dedup → fetch → classify → render → deliver.
+# Стадии связаны ограниченными очередями, у каждой свой пул воркеров. Читатели сокетов
+# только кладут подпись в первую очередь и никогда не ждут: при переполнении элемент сбрасывается.
+class NotificationPipeline:
+    STAGES = ("dedup", "fetch", "classify", "render", "deliver")
+
+    def __init__(self, queue_size=PIPELINE_QUEUE_SIZE, fetch_workers=PIPELINE_FETCH_WORKERS, policy=PIPELINE_OVERLOAD_POLICY):
+        self.policy = policy
+        self.queues = {stage: asyncio.Queue(maxsize=queue_size) for stage in self.STAGES}
+        self.workers_per_stage = {"dedup": 1, "fetch": fetch_workers, "classify": 1, "render": 1, "deliver": 1}
+        self.handlers = {
+            "dedup": self.dedup, "fetch": self.fetch, "classify": self.classify,
+            "render": self.render, "deliver": self.deliver,
+        }
+        self.workers = []
+        self.retry_tasks = set()  # Отложенные повторы getTransaction для быстрых уведомлений
+        self.shed = 0
+
+    def start(self):
+        if self.workers:
+            return
+        for stage in self.STAGES:
+            for _ in range(self.workers_per_stage[stage]):
+                self.workers.append(asyncio.create_task(self.worker(stage)))
+
+    async def stop(self):
+        for task in [*self.workers, *self.retry_tasks]:
+            task.cancel()
+        await asyncio.gather(*self.workers, *self.retry_tasks, return_exceptions=True)
+        self.workers = []
+
+    def depths(self):
+        return {stage: queue.qsize() for stage, queue in self.queues.items()}
+
+    # Нагрузка конвейера: заполненность самой загруженной очереди, от 0 до 1
+    def pressure(self):
+        return max(queue.qsize() / queue.maxsize for queue in self.queues.values())
+
+    def drop(self, stage, reason, count=1):
+        self.shed += count
+        metrics.inc("dtracker_pipeline_shed_total", count, stage=stage, reason=reason)
+
+    # Политика sample: выше порога заполненности пропускаем только долю PIPELINE_SAMPLE_RATE
+    def sampled_out(self):
+        return self.policy == "sample" and self.pressure() >= PIPELINE_SHED_WATERMARK and random.random() >= PIPELINE_SAMPLE_RATE
+
+    # Ingest для читателей сокетов: не блокирует, при перегрузке сбрасывает по политике
+    def submit(self, signature, wallets, slot, source, logs=None):
+        self.start()
+        queue = self.queues["dedup"]
+        if queue.full():
+            self.drop("ingest", "full")
+            return False
+        if self.sampled_out():
+            self.drop("ingest", "sampled")
+            return False
+        queue.put_nowait(PipelineItem(signature, wallets, slot, source, logs))
+        return True
+
+    # Ingest для догрузки (в режиме program через неё идут все транзакции). Политика перегрузки
+    # действует и здесь: sample прореживает, drop_newest сбрасывает при полной очереди,
+    # drop_unknown ждёт места и отбрасывает наименее ценные типы в classify
+    async def put(self, signature, wallets, slot, source):
+        self.start()
+        queue = self.queues["dedup"]
+        if self.policy == "drop_newest" and queue.full():
+            self.drop("backfill", "full")
+            return False
+        if self.sampled_out():
+            self.drop("backfill", "sampled")
+            return False
+        await queue.put(PipelineItem(signature, wallets, slot, source))
+        return True
+
+    async def worker(self, stage):
+        queue = self.queues[stage]
+        handler = self.handlers[stage]
+        while True:
+            item = await queue.get()
+            try:
+                await handler(item)
+                metrics.inc("dtracker_pipeline_processed_total", stage=stage)
+            except Exception as e:
+                logger.error(f"Ошибка стадии {stage} для {item.signature} ({item.source}): {str(e)}")
+            finally:
+                queue.task_done()
+
+    # Одна подпись приходит через несколько подписок и догрузку: каждую подписку обрабатываем один раз
+    async def dedup(self, item):
+        seen = signature_cache.entry(item.signature).seen_wallets
+        wallets = [wallet for wallet in item.wallets if wallet.key not in seen]
+        if not wallets:
             return
+        seen.update(wallet.key for wallet in wallets)
+        item.wallets = wallets
+        if item.logs is not None:
+            item.deadline = time.monotonic() + FAST_CONFIRM_TIMEOUT
+            self.announce(item)
+        await self.queues["fetch"].put(item)
 
-        # Подписываемся на изменения аккаунта
-        await ws.account_subscribe(address_pubkey)
-        first_resp = await ws.recv()
+    # Быстрое уведомление по логам, не дожидаясь getTransaction
+    def announce(self, item):
+        try:
+            tx_type = classify_logs(logs_decoder.decode(item.logs))
+        except msgspec.ValidationError as e:
+            logger.error(f"Не удалось разобрать логи {item.signature}: {str(e)}")
+            return
+        match = PROVISIONAL_MATCH.get(tx_type, 0)
+        for wallet in item.wallets:
+            if not match & wallet.types or wallet.chat_id in item.announced:
+                continue
+            text = format_provisional(wallet.name, item.signature, tx_type)
+            # False — чат уже получил эту подпись через другой свой кошелёк: после подтверждения render его пропустит
+            if notifier.send_alert(wallet.chat_id, text, parse_mode='Markdown', signature=item.signature, provisional=True):
+                item.announced.add(wallet.chat_id)
+
+    def retract(self, item):
+        for chat_id in item.announced:
+            notifier.retract_alert(chat_id, item.signature)
+        item.announced = set()
+
+    async def fetch(self, item):
+        error = None
+        try:
+            item.tx = await signature_cache.get_transaction(item.signature)
+        except Exception as e:
+            error = e
+        if item.tx:
+            await self.queues["classify"].put(item)
+            return
+        # Уведомление processed: транзакция ещё не подтверждена, ждём, а не сдаёмся. Так же и там,
+        # где быстрого уведомления не было (тип по логам не подошёл, чат уже уведомлён другим кошельком)
+        if item.logs is not None:
+            self.confirm_later(item)
+            return
+        # Не получилось: разрешаем повторную обработку (например, догрузкой)
+        signature_cache.entry(item.signature).seen_wallets.difference_update(wallet.key for wallet in item.wallets)
+        if error is not None:
+            raise error
+        for wallet in item.wallets:
+            notify_wallet_error(wallet, f"Не удалось получить детали транзакции {item.signature} для кошелька {wallet.name}.")
 
-        # Проверяем, является ли first_resp списком
-        logger.info(f"Получен ответ от WebSocket: {first_resp}")
-        if isinstance(first_resp, list) and len(first_resp) > 0:
-            subscription_id = first_resp[0].result
+    def confirm_later(self, item):
+        delay = min(FAST_CONFIRM_RETRY_BASE * 2 ** item.attempts, FAST_CONFIRM_RETRY_MAX)
+        item.attempts += 1
+        if time.monotonic() + delay > item.deadline:
+            logger.warning(f"Транзакция {item.signature} не подтвердилась за {FAST_CONFIRM_TIMEOUT:.0f} с" + (", отзываем быстрые уведомления" if item.announced else ""))
+            if item.announced:
+                metrics.inc("dtracker_fast_alerts_total", len(item.announced), outcome="expired")
+                self.retract(item)
+            # Если транзакция всё же появится, её подхватит догрузка
+            signature_cache.entry(item.signature).seen_wallets.difference_update(wallet.key for wallet in item.wallets)
+            return
+        task = asyncio.create_task(self.refetch(item, delay))
+        self.retry_tasks.add(task)
+        task.add_done_callback(self.retry_tasks.discard)
+
+    async def refetch(self, item, delay):
+        await asyncio.sleep(delay)
+        await self.queues["fetch"].put(item)
+
+    async def classify(self, item):
+        # Подтверждённая транзакция упала: уведомлять не о чем ни по одному элементу. Быстрые уведомления
+        # этого элемента отзываем; соседний элемент той же подписи без быстрых уведомлений тоже молчит,
+        # хотя после отзыва подпись в чате уже не занята
+        if item.tx.meta is not None and item.tx.meta.err is not None:
+            if item.announced:
+                logger.info(f"Транзакция {item.signature} не прошла: {item.tx.meta.err}, отзываем быстрые уведомления")
+            self.retract(item)
+            return
+
+        # Под нагрузкой политика drop_unknown отбрасывает наименее ценные типы
+        shed_types = ()
+        if self.policy == "drop_unknown":
+            pressure = self.pressure()
+            if pressure >= PIPELINE_SHED_WATERMARK:
+                level = (pressure - PIPELINE_SHED_WATERMARK) / max(1e-9, 1 - PIPELINE_SHED_WATERMARK)
+                shed_types = SHED_ORDER[:1 + int(level * (len(SHED_ORDER) - 1))]
+
+        # Классифицируем один раз на адрес: суммы зависят от того, чей это кошелёк.
+        # Подписчики адреса отбираются одним AND маски типа с маской подписки
+        classifications = {}
+        for wallet in item.wallets:
+            try:
+                classification = classifications.get(wallet.address)
+                if classification is None:
+                    # Точку отсчёта двигаем только подписями из истории самого адреса: транзакция с его
+                    # токен-аккаунта (входящий перевод SPL) в getSignaturesForAddress(адрес) не попадёт
+                    if wallet.address in item.tx.transaction.message.account_keys:
+                        record_last_tx(wallet.address, item.signature, item.slot)
+                    classification = classifications[wallet.address] = classify_transaction(item.tx, wallet.address)
+            except Exception as e:
+                logger.error(f"Ошибка классификации для {wallet.name} ({item.source}): {str(e)}")
+                notify_wallet_error(wallet, f"Ошибка мониторинга {wallet.name} ({item.source}): {str(e)}")
+                continue
+            if not type_selected(classification.tx_type, wallet.types):
+                continue
+            if classification.tx_type in shed_types:
+                self.drop("classify", classification.tx_type)
+                continue
+            item.alerts.append((wallet, classification))
+        # Быстрое уведомление ушло, а по суммам тип не подходит подписке (или сброшен): отзываем
+        if item.announced:
+            confirmed = {wallet.chat_id for wallet, _ in item.alerts}
+            for chat_id in item.announced - confirmed:
+                notifier.retract_alert(chat_id, item.signature)
+            item.announced &= confirmed
+        if item.alerts:
+            await self.queues["render"].put(item)
+
+    async def render(self, item):
+        alerts = []
+        for wallet, classification in item.alerts:
+            # Чат уже получил эту подпись через другой кошелёк: не тратимся на текст
+            # (кроме чатов, где быстрое уведомление ждёт правки)
+            if wallet.chat_id in signature_cache.entry(item.signature).notified_chats and wallet.chat_id not in item.announced:
+                continue
+            try:
+                alerts.append((wallet, classification, format_alert(wallet.name, item.signature, classification)))
+            except Exception as e:
+                logger.error(f"Ошибка формирования уведомления для {wallet.name} ({item.source}): {str(e)}")
+                notify_wallet_error(wallet, f"Ошибка мониторинга {wallet.name} ({item.source}): {str(e)}")
+        item.alerts = alerts
+        if alerts:
+            await self.queues["deliver"].put(item)
+
+    async def deliver(self, item):
+        # Очередь Telegram переполнена: ждём, давление поднимается по очередям до ingest
+        while notifier.depth() >= PIPELINE_DELIVER_HIGH_WATER:
+            await asyncio.sleep(0.05)
+        for wallet, classification, text in item.alerts:
+            if wallet.chat_id in item.announced:
+                notifier.confirm_alert(wallet.chat_id, text, parse_mode='Markdown', signature=item.signature)
+            else:
+                notifier.send_alert(wallet.chat_id, text, parse_mode='Markdown', signature=item.signature)
+            logger.info(f"Уведомление отправлено для {wallet.name}: {classification.tx_type}")
+
+pipeline = NotificationPipeline()
+
+# Режим приёма: program — общая подписка на токен-аккаунты с фильтрацией владельца на клиенте
+# (подписи транзакций забирает догрузка, поэтому на один запрос RPC больше),
+# logs — logsSubscribe с фильтром mentions на каждый кошелёк (узел присылает только наши транзакции)
+INGEST_MODE = os.getenv("INGEST_MODE", "program")
+LOGS_MAX_CONNECTIONS = int(os.getenv("LOGS_MAX_CONNECTIONS", 4))  # Верхняя граница пула соединений
+LOGS_SUBSCRIPTIONS_PER_CONNECTION = int(os.getenv("LOGS_SUBSCRIPTIONS_PER_CONNECTION", 500))  # Лимит подписок провайдера на сокет
+LOGS_REBALANCE_SLACK = 0.25  # Допустимый перекос нагрузки между соединениями до переноса подписок
+
+if INGEST_MODE not in ("program", "logs"):
+    raise ValueError(f"INGEST_MODE должен быть program или logs, получено {INGEST_MODE!r}")
+
+# Режим уведомлений: confirmed — одно сообщение после getTransaction,
+# fast — сразу по логам на commitment processed, затем правка с суммами после подтверждения
+ALERT_MODE = os.getenv("ALERT_MODE", "confirmed")
+FAST_CONFIRM_TIMEOUT = float(os.getenv("FAST_CONFIRM_TIMEOUT", 60))  # Не подтвердилась за столько секунд — отзываем
+FAST_CONFIRM_RETRY_BASE = 0.4  # Первая пауза перед повтором getTransaction, сек (примерно слот)
+FAST_CONFIRM_RETRY_MAX = 5.0
+
+if ALERT_MODE not in ("confirmed", "fast"):
+    raise ValueError(f"ALERT_MODE должен быть confirmed или fast, получено {ALERT_MODE!r}")
+if ALERT_MODE == "fast" and INGEST_MODE != "logs":
+    raise ValueError("ALERT_MODE=fast классифицирует по логам и требует INGEST_MODE=logs")
+
+LOGS_COMMITMENT = "processed" if ALERT_MODE == "fast" else "confirmed"
+
+metrics.describe("dtracker_fast_alerts_total", "counter", "Быстрые уведомления: announced, confirmed, retracted, expired")
+
+# Подписка чата на адрес: на один адрес может быть подписано сколько угодно чатов
+class Subscriber:
+    __slots__ = ("key", "address", "chat_id", "name", "types", "error_notified")
+
+    def __init__(self, address, chat_id, name, types):
+        self.key = (chat_id, name)
+        self.address = address
+        self.chat_id = chat_id
+        self.name = name
+        self.types = types  # Битовая маска выбранных типов (types_mask)
+        self.error_notified = False
+
+# Хаб подписок: одна подписка на программу, уведомления раздаются всем кошелькам.
+# Индекс по адресу: монитор на каждый уникальный адрес один, подписчики его делят
+class ProgramSubscriptionHub:
+    def __init__(self, program_ids):
+        self.program_ids = list(program_ids)
+        self.wallets_by_address = {}  # address -> {(chat_id, name): Subscriber}
+        self.tasks = {}  # program_id -> asyncio.Task
+        self.subscribed = set()  # Программы с подтверждённой подпиской
+
+    # Возвращает True, если адрес раньше не отслеживался и ему нужен свой монитор
+    def add_wallet(self, address, chat_id, name, types):
+        address = sys.intern(address)  # Ключи транзакций интернированы: поиск сравнивает указатели
+        wallets = self.wallets_by_address.get(address)
+        new_address = wallets is None
+        if new_address:
+            wallets = self.wallets_by_address[address] = {}
+        wallets[(chat_id, name)] = Subscriber(address, chat_id, name, types)
+        logger.info(f"Кошелек {name} ({address}) чата {chat_id} подключен к хабу, подписчиков адреса: {len(wallets)}, адресов в индексе: {len(self.wallets_by_address)}")
+        if not new_address:
+            return False
+        if INGEST_MODE == "logs":
+            # logsSubscribe с mentions видит и прямые переводы SOL: подписка на аккаунт не нужна
+            logs_pool.add_address(address)
+        else:
+            self.ensure_started()
+            # Прямые операции с SOL видит только подписка на сам аккаунт
+            account_pool.add_address(address)
+        return True
+
+    # Возвращает True, если у адреса не осталось подписчиков
+    def remove_wallet(self, address, chat_id, name):
+        wallets = self.wallets_by_address.get(address)
+        if wallets is None:
+            return False
+        wallets.pop((chat_id, name), None)
+        if wallets:
+            return False
+        del self.wallets_by_address[address]
+        logs_pool.remove_address(address)
+        account_pool.remove_address(address)
+        return True
+
+    async def stop(self):
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        self.tasks.clear()
+
+    # Запускаем подписки на программы под надзором
+    def ensure_started(self):
+        for program_id in self.program_ids:
+            task = self.tasks.get(program_id)
+            if task is None or task.done():
+                self.tasks[program_id] = asyncio.create_task(
+                    supervise(f"на программу {program_id}", "program", lambda reconnected, program_id=program_id: self.run_program(program_id, reconnected))
+                )
+
+    async def run_program(self, program_id, reconnected):
+        # Сообщения читаем как сырой JSON, чтобы декодировать каждое уведомление ровно один раз
+        async with ws_connect() as ws:
+            await ws.send(json.dumps({
+                "jsonrpc": "2.0", "id": 1, "method": "programSubscribe",
+                "params": [program_id, {"encoding": "jsonParsed", "commitment": "confirmed", "filters": [{"dataSize": TOKEN_ACCOUNT_SIZE}]}],
+            }))
+            subscription_id = await read_subscription_id(ws)
+            logger.info(f"Подписка на программу {program_id} успешна, ID подписки: {subscription_id}")
+            self.subscribed.add(program_id)
+
+            # Пока сокет лежал, транзакции могли пройти мимо: догружаем по всем кошелькам
+            if reconnected:
+                for address in list(self.wallets_by_address):
+                    backfiller.schedule(address)
+                for account, (_, owner) in list(backfiller.cursors.items()):
+                    backfiller.schedule(account, owner)
+
+            try:
+                while True:
+                    # Поток программы никогда не молчит долго: тишина значит, что соединение повисло
+                    raw = await asyncio.wait_for(ws.recv(), timeout=PROGRAM_IDLE_TIMEOUT)
+                    try:
+                        self.handle_notification(program_id, program_message_decoder.decode(raw))
+                    except Exception as e:
+                        logger.error(f"Ошибка обработки уведомления программы {program_id}: {str(e)}")
+            finally:
+                self.subscribed.discard(program_id)
+                # Отписываемся при завершении, если соединение ещё живо
+                if ws.open:
+                    await ws.send(json.dumps({
+                        "jsonrpc": "2.0", "id": 2, "method": "programUnsubscribe", "params": [subscription_id],
+                    }))
+
+    def handle_notification(self, program_id, msg):
+        data = msg.params.result if msg.params is not None else None
+        if data is None:
+            return
+
+        metrics.inc("dtracker_notifications_total", stage="received", program=program_id)
+
+        # Изменился токен-аккаунт: отслеживается ли его владелец
+        value = data.value
+        account_data = value.account.data
+        owner = account_data.parsed.info.owner if isinstance(account_data, AccountData) and account_data.parsed is not None else ""
+        if not owner or owner not in self.wallets_by_address:
+            metrics.inc("dtracker_notifications_total", stage="filtered", program=program_id)
+            return
+        metrics.inc("dtracker_notifications_total", stage="matched", program=program_id)
+
+        logger.info(f"Изменился токен-аккаунт {value.pubkey} кошелька {owner} (программа {program_id})")
+
+        # Подписи в уведомлении аккаунта нет: новые транзакции забирает догрузка истории самого токен-аккаунта
+        # (входящий перевод владельца не упоминает), дальше детали, классификация и отправка идут в конвейере
+        backfiller.schedule(value.pubkey, owner, data.context.slot)
+
+program_hub = ProgramSubscriptionHub(PROGRAM_IDS)
+
+# Одно соединение пула: держит подписки пула (logsSubscribe, accountSubscribe) для закреплённых за ним адресов
+class SubscriptionConnection:
+    def __init__(self, pool, label):
+        self.pool = pool
+        self.label = label
+        self.addresses = set()  # Адреса, закреплённые за соединением
+        self.subscriptions = {}  # address -> subscription_id
+        self.addresses_by_subscription = {}  # subscription_id -> address
+        self.pending = {}  # id запроса -> адрес, ждущий подтверждения подписки
+        self.releases = {}  # address -> соединение, которое отпустит адрес, когда подписка здесь подтвердится
+        self.draining = False  # Всё перенесено на другие соединения: закрываемся после последней отписки
+        self.next_request_id = 1
+        self.ws = None
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(supervise(f"{self.pool.SUBSCRIBE} {self.label}", self.pool.KIND, self.run))
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def run(self, reconnected):
+        async with ws_connect() as ws:
+            self.ws = ws
+            try:
+                # Подписки переживают только соединение: поднимаем все закреплённые адреса заново
+                for address in list(self.addresses):
+                    await self.subscribe(address)
+                if reconnected:
+                    for address in list(self.addresses):
+                        backfiller.schedule(address)
+                async for raw in ws:
+                    try:
+                        await self.handle(self.pool.decoder.decode(raw))
+                    except Exception as e:
+                        logger.error(f"Ошибка обработки сообщения {self.pool.SUBSCRIBE} {self.label}: {str(e)}")
+            finally:
+                self.ws = None
+                self.subscriptions.clear()
+                self.addresses_by_subscription.clear()
+                self.pending.clear()
+
+    async def send(self, method, params, address=None):
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        if address is not None:
+            self.pending[request_id] = address
+        await self.ws.send(json.dumps({"jsonrpc": "2.0", "id": request_id, "method": method, "params": params}))
+
+    async def subscribe(self, address):
+        # Без соединения подписка поднимется в run(); повторно не подписываемся
+        if self.ws is None or address in self.subscriptions or address in self.pending.values():
+            return
+        await self.send(self.pool.SUBSCRIBE, self.pool.subscribe_params(address), address)
+
+    async def unsubscribe(self, address):
+        subscription_id = self.subscriptions.pop(address, None)
+        if subscription_id is None:
+            return
+        self.addresses_by_subscription.pop(subscription_id, None)
+        if self.ws is not None and self.ws.open:
+            await self.send(self.pool.UNSUBSCRIBE, [subscription_id])
+
+    # Отписка после переноса адреса; опустевшее выводимое соединение закрываем
+    async def release(self, address):
+        await self.unsubscribe(address)
+        if self.draining and not self.subscriptions and not self.pending:
+            self.pool.close(self)
+
+    async def handle(self, msg):
+        if msg.id is not None:
+            address = self.pending.pop(msg.id, None)
+            if address is None:
+                return  # Ответ на отписку
+            subscription_id = msg.result
+            if subscription_id is None:
+                logger.error(f"{self.pool.SUBSCRIBE} {address} отклонена: {msg.error}")
+                return
+            self.subscriptions[address] = subscription_id
+            self.addresses_by_subscription[subscription_id] = address
+            # Подписка здесь живая: соединение, с которого адрес переносили, может отписаться
+            source = self.releases.pop(address, None)
+            if source is not None:
+                await source.release(address)
+            # Пока ждали ответа, адрес удалили или перенесли на другое соединение
+            if address not in self.addresses:
+                await self.release(address)
+            return
+
+        if msg.method != self.pool.NOTIFICATION or msg.params is None or msg.params.result is None:
+            return
+        address = self.addresses_by_subscription.get(msg.params.subscription)
+        if address is not None:
+            self.pool.handle_notification(address, msg.params.result)
+
+# Пул соединений с подписками на адреса: подписки распределяются по ограниченному числу сокетов
+# и перераспределяются при добавлении и удалении кошельков. Протокол подписки задаёт подкласс
+class SubscriptionPool:
+    KIND = ""  # Метка переподключений в dtracker_reconnects_total
+    SUBSCRIBE = ""
+    UNSUBSCRIBE = ""
+    NOTIFICATION = ""
+    decoder = None
+
+    def __init__(self, max_connections=LOGS_MAX_CONNECTIONS, per_connection=LOGS_SUBSCRIPTIONS_PER_CONNECTION):
+        self.max_connections = max_connections
+        self.per_connection = per_connection
+        self.connections = []
+        self.owners = {}  # address -> SubscriptionConnection
+        self.next_label = 1
+        self.pending_tasks = set()  # Отправки подписок, запущенные из синхронного кода
+        self.draining = set()  # Выводимые соединения, которые ждут подтверждения переноса своих адресов
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.pending_tasks.add(task)
+        task.add_done_callback(self.pending_tasks.discard)
+
+    def subscribed_count(self):
+        return sum(len(connection.subscriptions) for connection in self.connections)
+
+    def add_address(self, address):
+        if address in self.owners:
+            return
+        self.assign(address, self.pick_connection())
+        self.rebalance()
+
+    def remove_address(self, address):
+        connection = self.owners.pop(address, None)
+        if connection is None:
+            return
+        connection.addresses.discard(address)
+        self.spawn(connection.unsubscribe(address))
+        # Адрес был в пути с другого соединения: там его уже никто не перенесёт
+        source = connection.releases.pop(address, None)
+        if source is not None:
+            self.spawn(source.release(address))
+        self.rebalance()
+
+    # Наименее загруженное соединение со свободным местом; новое, пока пул не заполнен
+    def pick_connection(self):
+        free = [connection for connection in self.connections if len(connection.addresses) < self.per_connection]
+        if free:
+            return min(free, key=lambda connection: len(connection.addresses))
+        if len(self.connections) < self.max_connections:
+            connection = SubscriptionConnection(self, f"#{self.next_label}")
+            self.next_label += 1
+            self.connections.append(connection)
+            connection.start()
+            return connection
+        # Пул заполнен: перегружаем наименее занятое соединение, но не открываем новых
+        return min(self.connections, key=lambda connection: len(connection.addresses))
+
+    def assign(self, address, connection):
+        connection.addresses.add(address)
+        self.owners[address] = connection
+        self.spawn(connection.subscribe(address))
+
+    # Перенос: старое соединение отписывается, только когда новое подтвердило подписку (SubscriptionConnection.handle),
+    # чтобы не было окна без покрытия; пока обе живы, дубли уведомлений отсекает кэш подписей
+    def move(self, address, source, target):
+        source.addresses.discard(address)
+        # Адрес ещё в пути с третьего соединения: живая подписка там, её и отпускаем после переноса.
+        # Неподтверждённая подписка source отпустит себя сама, когда придёт ответ
+        source = source.releases.pop(address, None) or source
+        if address in target.subscriptions:
+            # Вернулся туда, где подписка ещё жива: вторая не нужна
+            target.addresses.add(address)
+            self.owners[address] = target
+            if source is not target:
+                self.spawn(source.release(address))
+            return
+        target.releases[address] = source
+        self.assign(address, target)
+
+    def close(self, connection):
+        self.draining.discard(connection)
+        self.spawn(connection.stop())
+
+    def rebalance(self):
+        if not self.connections:
+            return
+        total = len(self.owners)
+        # Адреса помещаются в меньшее число соединений: освобождаем наименее занятое и закрываем его
+        needed = max(1, -(-total // self.per_connection))
+        while len(self.connections) > needed:
+            victim = min(self.connections, key=lambda connection: len(connection.addresses))
+            self.connections.remove(victim)
+            for address in list(victim.addresses):
+                target = min(self.connections, key=lambda connection: len(connection.addresses))
+                self.move(address, victim, target)
+            # Закроется, когда цели подтвердят подписки и оно отпустит последний адрес
+            victim.draining = True
+            self.draining.add(victim)
+            if not victim.subscriptions and not victim.pending:
+                self.close(victim)
+        if len(self.connections) < 2:
+            return
+        # Выравниваем нагрузку, если перекос больше допустимого
+        limit = int(-(-total // len(self.connections)) * (1 + LOGS_REBALANCE_SLACK))
+        for source in self.connections:
+            while len(source.addresses) > limit:
+                target = min(self.connections, key=lambda connection: len(connection.addresses))
+                if len(target.addresses) + 1 >= len(source.addresses):
+                    break
+                self.move(next(iter(source.addresses)), source, target)
+
+    async def stop(self):
+        for task in list(self.pending_tasks):
+            task.cancel()
+        await asyncio.gather(*(connection.stop() for connection in self.connections + list(self.draining)), return_exceptions=True)
+
+    def subscribe_params(self, address):
+        raise NotImplementedError
+
+    def handle_notification(self, address, data):
+        raise NotImplementedError
+
+# Подписки mentions на каждый кошелёк (режим logs)
+class LogsSubscriptionPool(SubscriptionPool):
+    KIND = "logs"
+    SUBSCRIBE = "logsSubscribe"
+    UNSUBSCRIBE = "logsUnsubscribe"
+    NOTIFICATION = "logsNotification"
+    decoder = logs_message_decoder
+
+    def subscribe_params(self, address):
+        return [{"mentions": [address]}, {"commitment": LOGS_COMMITMENT}]
+
+    def handle_notification(self, address, data):
+        metrics.inc("dtracker_notifications_total", stage="received", program="logs")
+        value = data.value
+        wallets = program_hub.wallets_by_address.get(address)
+        signature = value.signature
+        # Неудавшиеся транзакции не меняют балансы: уведомлять не о чем
+        if not wallets or not signature or value.err:
+            metrics.inc("dtracker_notifications_total", stage="filtered", program="logs")
+            return
+        metrics.inc("dtracker_notifications_total", stage="matched", program="logs")
+        matched = list(wallets.values())
+        slot = data.context.slot
+
+        logger.info(f"Новая транзакция через logsSubscribe для {address}: {signature}")
+        pipeline.submit(signature, matched, slot, "logsSubscribe", value.logs if ALERT_MODE == "fast" else None)
+
+logs_pool = LogsSubscriptionPool()
+
+# Подписки на изменения самого кошелька (режим program): прямые переводы SOL не трогают токен-аккаунты.
+# Уведомление аккаунта не содержит подписи, поэтому новые транзакции забираем догрузкой после last_tx.
+# Лимиты соединений те же, что у пула logsSubscribe: это ограничения провайдера на сокеты
+class AccountSubscriptionPool(SubscriptionPool):
+    KIND = "account"
+    SUBSCRIBE = "accountSubscribe"
+    UNSUBSCRIBE = "accountUnsubscribe"
+    NOTIFICATION = "accountNotification"
+    decoder = account_message_decoder
+
+    def subscribe_params(self, address):
+        return [address, {"encoding": "base64", "commitment": "confirmed"}]
+
+    def handle_notification(self, address, data):
+        metrics.inc("dtracker_notifications_total", stage="received", program="account")
+        if address not in program_hub.wallets_by_address:
+            metrics.inc("dtracker_notifications_total", stage="filtered", program="account")
+            return
+        metrics.inc("dtracker_notifications_total", stage="matched", program="account")
+        backfiller.schedule(address)
+
+account_pool = AccountSubscriptionPool()
+
+# Параметры догрузки пропущенных транзакций
+BACKFILL_PAGE_LIMIT = 100  # Подписей на страницу getSignaturesForAddress
+BACKFILL_MAX_PAGES = int(os.getenv("BACKFILL_MAX_PAGES", 5))  # Глубже не идём, чтобы не заваливать RPC
+# В режиме program через догрузку идёт каждое уведомление, поэтому и параллельность выше
+BACKFILL_CONCURRENCY = int(os.getenv("BACKFILL_CONCURRENCY", 16 if INGEST_MODE == "program" else 2))  # Адресов, догружаемых одновременно
+
+# Догрузка пропусков: подписи после last_tx через getSignaturesForAddress,
+# детали транзакций батчами через общий кэш подписей.
+class Backfiller:
+    def __init__(self, concurrency=BACKFILL_CONCURRENCY):
+        self.concurrency = concurrency
+        self.queue = asyncio.Queue()
+        self.queued = set()  # Адреса в очереди: повторные запросы склеиваются
+        self.cursors = {}  # токен-аккаунт -> [последняя догруженная подпись, владелец]
+        self.workers = []
+
+    # owner — адрес токен-аккаунта, чьи транзакции приписываются кошельку owner;
+    # slot — слот изменения, нижняя граница, пока у токен-аккаунта нет курсора
+    def schedule(self, address, owner=None, slot=None):
+        if address in self.queued:
+            return
+        self.queued.add(address)
+        self.queue.put_nowait((address, owner, slot))
+        if not self.workers:
+            self.start()
+
+    def start(self):
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+
+    async def worker(self):
+        while True:
+            address, owner, slot = await self.queue.get()
+            self.queued.discard(address)
+            try:
+                if owner is None:
+                    await self.backfill(address)
+                else:
+                    await self.backfill_token_account(address, owner, slot)
+            except Exception as e:
+                logger.error(f"Ошибка догрузки транзакций {address}: {str(e)}")
+
+    # Подписи адреса после until, от новых к старым
+    async def list_signatures(self, address, until, max_pages=BACKFILL_MAX_PAGES):
+        entries = []
+        before = None
+        for _ in range(max_pages):
+            params = {"limit": BACKFILL_PAGE_LIMIT, "commitment": "confirmed"}
+            if until:
+                params["until"] = until
+            if before:
+                params["before"] = before
+            page = await tx_fetcher.request("getSignaturesForAddress", [address, params], signatures_decoder) or []
+            entries.extend(page)
+            if len(page) < BACKFILL_PAGE_LIMIT:
+                break
+            before = page[-1].signature
+        return entries
+
+    async def backfill(self, address):
+        wallets = list(program_hub.wallets_by_address.get(address, {}).values())
+        if not wallets:
+            return
+        seen = last_seen.get(address)
+        if seen is None:
+            # Точки отсчёта ещё нет: не присылаем историю, только запоминаем последнюю подпись.
+            # Пустая история — тоже точка отсчёта: всё, что появится у адреса дальше, новое
+            page = await tx_fetcher.request("getSignaturesForAddress", [address, {"limit": 1, "commitment": "confirmed"}], signatures_decoder) or []
+            if page:
+                record_last_tx(address, page[0].signature, page[0].slot)
+            else:
+                last_seen.setdefault(address, [None, None])
+            return
+        until = seen[0]
+        entries = await self.list_signatures(address, until)
+        logger.info(f"Догрузка {address}: {len(entries)} транзакций после {until or 'начала истории'}")
+        await self.submit(entries, wallets, "догрузка")
+
+    # Входящий перевод SPL меняет только токен-аккаунт: сам кошелёк в транзакции не упомянут,
+    # и getSignaturesForAddress(кошелёк) её не вернёт. Историю берём у токен-аккаунта
+    async def backfill_token_account(self, account, owner, slot):
+        wallets = list(program_hub.wallets_by_address.get(owner, {}).values())
+        if not wallets:
+            return
+        cursor = self.cursors.get(account)
+        if cursor is None:
+            # Первое изменение после старта: новое — только начиная со слота уведомления
+            entries = await self.list_signatures(account, None, max_pages=1)
+            entries = [entry for entry in entries if entry.slot is not None and slot is not None and entry.slot >= slot]
         else:
-            subscription_id = first_resp.result
+            entries = await self.list_signatures(account, cursor[0])
+        if entries:
+            self.cursors[account] = [entries[0].signature, owner]
+        await self.submit(entries, wallets, f"токен-аккаунт {account}")
+
+    async def submit(self, entries, wallets, source):
+        entries = [entry for entry in reversed(entries) if not entry.err]  # От старых к новым
+        if not entries:
+            return
+        metrics.inc("dtracker_backfilled_signatures_total", len(entries))
+        # Догрузка не читает сокет, поэтому может ждать места в конвейере (сбрасывает только политика перегрузки);
+        # getTransaction воркеров fetch склеиваются в JSON-RPC батчи
+        for entry in entries:
+            await pipeline.put(entry.signature, wallets, entry.slot, source)
+
+backfiller = Backfiller()
+
+# Мониторинг кошелька через все программы; types — маска типов (types_mask)
+async def monitor_wallet(address, chat_id, name, types):
+    # Проверяем адрес заранее, чтобы не регистрировать в хабе мусор
+    try:
+        Pubkey.from_string(address)
+    except Exception as e:
+        logger.error(f"Ошибка преобразования address {address} в Pubkey: {str(e)}")
+        return
+
+    # В шардированном режиме подписками владеет воркер, выбранный по адресу
+    if shard_coordinator is not None:
+        shard_coordinator.add_wallet(address, chat_id, name, types)
+        return
+
+    # Токен-аккаунты кошелька (в том числе при свапах Jupiter, Pump Fun и Raydium) видит общая
+    # подписка хаба на SPL Token (в режиме logs — подписка mentions на сам кошелёк). Адрес, который уже
+    # отслеживается для другого чата, получает только нового подписчика
+    if not program_hub.add_wallet(address, chat_id, name, types):
+        return
+
+    # Догружаем пропущенное с последней сохранённой транзакции (для нового кошелька только ставим точку отсчёта)
+    backfiller.schedule(address)
+
+# Снятие подписки чата с мониторинга (перед заменой или удалением); монитор адреса живёт, пока есть подписчики
+def unmonitor_wallet(address, chat_id, name):
+    if shard_coordinator is not None:
+        shard_coordinator.remove_wallet(address, chat_id, name)
+        return
+    program_hub.remove_wallet(address, chat_id, name)
 
-        logger.info(f"Подписка на изменения аккаунта {name} ({address}) успешна, ID подписки: {subscription_id}")
+# Все ли подписки этого процесса подтверждены узлом
+def subscriptions_covered():
+    if INGEST_MODE == "logs":
+        return logs_pool.subscribed_count() >= len(program_hub.wallets_by_address)
+    if program_hub.wallets_by_address and len(program_hub.subscribed) < len(program_hub.program_ids):
+        return False
+    return account_pool.subscribed_count() >= len(program_hub.wallets_by_address)
 
-        error_notified = False  # Флаг для отслеживания ошибок
+# Восстановление кошельков из реестра при старте: подписки поднимаются пачками
+async def restore_wallets():
+    started = time.monotonic()
+    wallets = wallet_registry.load()
+    if not wallets:
+        return
+    for address, signature in wallet_registry.load_checkpoints().items():
+        last_seen.setdefault(address, [signature, None])
+    async with wallet_lock:
+        tracked_wallets.update(wallets)
+
+    items = list(wallets.values())
+    for i in range(0, len(items), RESTORE_BATCH_SIZE):
+        for wallet in items[i:i + RESTORE_BATCH_SIZE]:
+            await monitor_wallet(wallet["address"], wallet["chat_id"], wallet["name"], wallet["types"])
+        if i + RESTORE_BATCH_SIZE < len(items):
+            await asyncio.sleep(RESTORE_BATCH_DELAY)
+    logger.info(f"Мониторинг {len(items)} кошельков запущен за {time.monotonic() - started:.2f} с")
+
+    # Замеряем время до полного покрытия: все подписки подтверждены узлом
+    deadline = started + RESTORE_COVERAGE_TIMEOUT
+    while time.monotonic() < deadline:
+        covered = shard_coordinator.covered(len(items)) if shard_coordinator is not None else subscriptions_covered()
+        if covered:
+            logger.info(f"Полное покрытие {len(items)} кошельков за {time.monotonic() - started:.2f} с")
+            return
+        await asyncio.sleep(0.1)
+    logger.warning(f"За {RESTORE_COVERAGE_TIMEOUT:.0f} с подписки подтверждены не для всех {len(items)} кошельков")
+
+# Шардирование мониторинга по процессам: воркеры держат подписки и конвейер до render,
+# фронтенд (этот процесс) — интерфейс бота, реестр и очередь отправки Telegram
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", 0))  # 0 — всё в одном процессе
+SHARD_VIRTUAL_NODES = 64  # Точек на кольце на воркер: ровнее распределение кошельков
+SHARD_HEARTBEAT_INTERVAL = 2.0  # Как часто воркер отчитывается фронтенду, сек
+SHARD_HEARTBEAT_TIMEOUT = 15.0  # Воркер без отчёта дольше этого считаем зависшим и перезапускаем
+SHARD_DEPTH_INTERVAL = 0.5  # Как часто фронтенд сообщает воркерам глубину очереди Telegram, сек
+SHARD_IPC_LIMIT = 1 << 20  # Максимальная строка IPC, байт
+
+# В режиме program каждый воркер открыл бы свою подписку на всю программу SPL Token
+# и получал бы весь её поток: шардирование делит только подписки mentions
+if SHARD_WORKERS > 0 and INGEST_MODE != "logs":
+    raise ValueError("SHARD_WORKERS делит подписки mentions по воркерам и требует INGEST_MODE=logs")
+
+metrics.describe("dtracker_shard_up", "gauge", "Воркер шарда запущен и присылает отчёты")
+metrics.describe("dtracker_shard_wallets", "gauge", "Кошельки, закреплённые за шардом")
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+# Консистентное хэширование: при добавлении или потере воркера переезжают только его кошельки
+class HashRing:
+    def __init__(self, virtual_nodes=SHARD_VIRTUAL_NODES):
+        self.virtual_nodes = virtual_nodes
+        self.points = []  # Отсортированные хэши точек
+        self.nodes = {}  # хэш точки -> узел
+
+    def add(self, node):
+        for i in range(self.virtual_nodes):
+            point = ring_hash(f"{node}#{i}")
+            self.nodes[point] = node
+            bisect.insort(self.points, point)
+
+    def remove(self, node):
+        self.points = [point for point in self.points if self.nodes[point] != node]
+        self.nodes = {point: self.nodes[point] for point in self.points}
+
+    def owner(self, key):
+        if not self.points:
+            return None
+        i = bisect.bisect(self.points, ring_hash(key)) % len(self.points)
+        return self.nodes[self.points[i]]
+
+# Процесс-воркер глазами фронтенда. IPC — JSON-строки: команды в stdin, события из stdout
+class ShardWorker:
+    def __init__(self, shard_id):
+        self.shard_id = shard_id
+        self.process = None
+        self.last_heartbeat = 0.0
+        self.report = None  # Последний отчёт воркера
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), "--shard-worker", str(self.shard_id),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, limit=SHARD_IPC_LIMIT,
+        )
+        self.last_heartbeat = time.monotonic()
+
+    def alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    def send(self, message):
+        if self.alive():
+            self.process.stdin.write((json.dumps(message) + "\n").encode())
+
+    async def stop(self):
+        if not self.alive():
+            return
+        # Закрытый stdin — сигнал воркеру завершиться самому
+        self.process.stdin.close()
         try:
-            async for msg in ws:
-                # Парсим сообщение от WebSocket
+            await asyncio.wait_for(self.process.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            self.process.kill()
+            await self.process.wait()
+
+class ShardCoordinator:
+    def __init__(self, count=SHARD_WORKERS):
+        self.count = count
+        self.ring = HashRing()
+        self.workers = {}  # shard_id -> ShardWorker
+        self.wallets = {}  # (chat_id, name) -> (address, types)
+        self.assignments = {}  # (chat_id, name) -> shard_id; все подписчики адреса попадают в один шард
+        self.tasks = []
+        self.stopping = False
+
+    def start(self):
+        for shard_id in range(self.count):
+            self.tasks.append(asyncio.create_task(
+                supervise(f"шарда {shard_id}", "shard", lambda reconnected, shard_id=shard_id: self.run_worker(shard_id))
+            ))
+        self.tasks.append(asyncio.create_task(self.watch()))
+
+    async def stop(self):
+        self.stopping = True
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    # Жизнь одного воркера: запуск, приём кошельков по кольцу, чтение событий до выхода процесса
+    async def run_worker(self, shard_id):
+        worker = ShardWorker(shard_id)
+        await worker.start()
+        logger.info(f"Шард {shard_id} запущен, PID {worker.process.pid}")
+        self.workers[shard_id] = worker
+        self.ring.add(shard_id)
+        self.rebalance()
+        try:
+            while True:
+                line = await worker.process.stdout.readline()
+                if not line:
+                    break
                 try:
-                    data = msg.result
-                    if not data:
-                        if not error_notified:
-                            await bot.send_message(chat_id=chat_id, text=f"Кошелек {name} ({address}) неактивен или не имеет транзакций.")
-                            error_notified = True
-                        continue
-
-                    # Получаем подпись транзакции
-                    signature = data.get("value", {}).get("signature")
-                    if not signature:
-                        continue
-
-                    logger.info(f"Новая транзакция для {name} (account_subscribe): {signature}")
-
-                    # Используем Solana JSON-RPC для получения деталей транзакции
-                    tx_response = solana_client.get_transaction(signature, encoding="jsonParsed")
-                    if not tx_response["result"]:
-                        if not error_notified:
-                            await bot.send_message(chat_id=chat_id, text=f"Не удалось получить детали транзакции {signature} для кошелька {name}.")
-                            error_notified = True
-                        continue
-
-                    tx = tx_response["result"]
-                    tx_type = classify_transaction(tx)
-                    if tx_type in types:
-                        # Упрощенные данные о транзакции (нужен API для точных данных)
-                        sol_amount = tx.get("meta", {}).get("fee", 0) / 1_000_000_000  # Лампорты в SOL (используем fee как пример)
-                        usd_amount = sol_amount * SOL_TO_USD
-                        token_amount = random.uniform(5000000, 10000000)  # Пример
-                        token_name = "NYCPR"  # Нужно получать через API
-                        token_price = 0.000037  # Пример
-                        market_cap = "300.4K"  # Пример
-
-                        msg = (
-                            f"#{name.upper()}\n"
-                            f"Swapped {sol_amount:.2f} #SOL (${usd_amount:,.2f}) for {token_amount:,.2f} #{token_name} @ ${token_price}\n"
-                            f"MC: ${market_cap}\n"
-                            f"#Solana | [ViewTx](https://solscan.io/tx/{signature}) | [Chart](https://www.dextools.io/app/en/solana)\n"
-                            f"👉 Купить можно тут: https://gmgn.ai/?ref=HiDMfJX4&chain=sol\n"
-                            f"👉 Купить через Bloom: https://t.me/BloomSolana_bot?start=ref_57Z29YIQ2J"
-                        )
-                        await bot.send_message(chat_id=chat_id, text=msg, parse_mode='Markdown')
-                        logger.info(f"Уведомление отправлено для {name}: {tx_type}")
+                    self.handle_event(worker, json.loads(line))
                 except Exception as e:
-                    logger.error(f"Ошибка обработки транзакции для {name} (account_subscribe): {str(e)}")
-                    if not error_notified:
-                        await bot.send_message(chat_id=chat_id, text=f"Ошибка мониторинга {name} (account_subscribe): {str(e)}")
-                        error_notified = True
+                    logger.error(f"Ошибка обработки события шарда {shard_id}: {str(e)}")
+            await worker.process.wait()
+            logger.error(f"Шард {shard_id} завершился с кодом {worker.process.returncode}")
         finally:
-            # Отписываемся при завершении
-            await ws.account_unsubscribe(subscription_id)
+            # Кошельки упавшего воркера сразу переезжают на живые и догружаются с last_tx
+            self.ring.remove(shard_id)
+            del self.workers[shard_id]
+            await asyncio.shield(worker.stop())
+            if not self.stopping:
+                self.rebalance()
+
+    def add_wallet(self, address, chat_id, name, types):
+        self.wallets[(chat_id, name)] = (address, types)
+        self.place((chat_id, name))
+
+    def remove_wallet(self, address, chat_id, name):
+        self.wallets.pop((chat_id, name), None)
+        worker = self.workers.get(self.assignments.pop((chat_id, name), None))
+        if worker is not None:
+            worker.send({"op": "remove", "address": address, "chat_id": chat_id, "name": name})
 
-# Мониторинг кошелька через все программы
-async def monitor_wallet(address, name, types, chat_id, bot):
-    # Запускаем мониторинг для SPL Token Program
-    asyncio.create_task(monitor_program_ws(address, name, types, chat_id, SPL_TOKEN_PROGRAM_ID, bot))
+    def place(self, key):
+        address, types = self.wallets[key]
+        chat_id, name = key
+        owner = self.ring.owner(address)
+        current = self.assignments.get(key)
+        if owner == current:
+            return
+        previous = self.workers.get(current)
+        if previous is not None:
+            previous.send({"op": "remove", "address": address, "chat_id": chat_id, "name": name})
+        worker = self.workers.get(owner)
+        if worker is None:
+            self.assignments.pop(key, None)
+            return
+        self.assignments[key] = owner
+        worker.send({
+            "op": "add", "address": address, "chat_id": chat_id, "name": name, "types": types,
+            "last_tx": last_seen.get(address, (None,))[0],
+        })
+
+    def rebalance(self):
+        for key in list(self.wallets):
+            self.place(key)
+
+    def handle_event(self, worker, event):
+        kind = event.get("event")
+        if kind == "alert":
+            notifier.send_alert(event["chat_id"], event["text"], event.get("parse_mode"), event.get("signature"), event.get("provisional", False))
+        elif kind == "confirm":
+            notifier.confirm_alert(event["chat_id"], event["text"], event.get("parse_mode"), event["signature"])
+        elif kind == "retract":
+            notifier.retract_alert(event["chat_id"], event["signature"])
+        elif kind == "last_tx":
+            record_last_tx(event["address"], event["signature"], event.get("slot"))
+        elif kind == "heartbeat":
+            worker.last_heartbeat = time.monotonic()
+            worker.report = event
+
+    # Глубина очереди Telegram для обратного давления в воркерах и проверка зависших воркеров
+    async def watch(self):
+        while True:
+            await asyncio.sleep(SHARD_DEPTH_INTERVAL)
+            depth = notifier.depth()
+            now = time.monotonic()
+            for worker in list(self.workers.values()):
+                worker.send({"op": "depth", "value": depth})
+                if now - worker.last_heartbeat > SHARD_HEARTBEAT_TIMEOUT and worker.alive():
+                    logger.error(f"Шард {worker.shard_id} не отчитывался {now - worker.last_heartbeat:.0f} с, перезапускаем")
+                    worker.process.kill()
+
+    def covered(self, total):
+        if len(self.workers) < self.count:
+            return False
+        reports = [worker.report for worker in self.workers.values()]
+        if any(report is None or not report["covered"] for report in reports):
+            return False
+        return sum(report["wallets"] for report in reports) >= total
+
+    def problems(self):
+        problems = []
+        now = time.monotonic()
+        for shard_id in range(self.count):
+            worker = self.workers.get(shard_id)
+            if worker is None or not worker.alive():
+                problems.append(f"шард {shard_id} не запущен")
+            elif now - worker.last_heartbeat > SHARD_HEARTBEAT_TIMEOUT:
+                problems.append(f"шард {shard_id} не отчитывается")
+            elif worker.report is not None:
+                problems.extend(f"шард {shard_id}: {problem}" for problem in worker.report["problems"])
+        return problems
+
+    def gauges(self):
+        gauges = []
+        for shard_id in range(self.count):
+            worker = self.workers.get(shard_id)
+            up = worker is not None and worker.alive() and worker.report is not None
+            gauges.append(("dtracker_shard_up", {"shard": shard_id}, int(up)))
+            gauges.append(("dtracker_shard_wallets", {"shard": shard_id}, sum(1 for owner in self.assignments.values() if owner == shard_id)))
+            if up:
+                for name, labels, value in worker.report["gauges"]:
+                    gauges.append((name, dict(labels, shard=shard_id), value))
+        return gauges
+
+    # Счётчики воркеров из последних отчётов, с меткой shard
+    def counters(self):
+        return self.reported("counters")
+
+    def histograms(self):
+        return self.reported("histograms")
+
+    def reported(self, kind):
+        reported = []
+        for worker in self.workers.values():
+            if worker.report is None:
+                continue
+            for name, labels, value in worker.report[kind]:
+                labels = tuple(sorted([*map(tuple, labels), ("shard", str(worker.shard_id))]))
+                reported.append(((name, labels), value))
+        return reported
+
+shard_coordinator = None  # ShardCoordinator во фронтенде при SHARD_WORKERS > 0
+
+# Связь воркера с фронтендом: подменяет notifier и wallet_registry внутри воркера
+class ShardUplink:
+    def __init__(self, transport):
+        self.transport = transport
+        self.telegram_depth = 0  # Глубина очереди Telegram во фронтенде, для обратного давления
 
-    # Запускаем мониторинг для Jupiter Aggregator
-    asyncio.create_task(monitor_program_ws(address, name, types, chat_id, JUPITER_PROGRAM_ID, bot))
+    def emit(self, event):
+        self.transport.write((json.dumps(event, ensure_ascii=False) + "\n").encode())
 
-    # Запускаем мониторинг для Pump Fun
-    asyncio.create_task(monitor_program_ws(address, name, types, chat_id, PUMP_FUN_PROGRAM_ID, bot))
+    # Дедупликация по (подпись, чат) во фронтенде, здесь уведомление всегда считается отправленным
+    def send_alert(self, chat_id, text, parse_mode=None, signature=None, provisional=False):
+        self.emit({"event": "alert", "chat_id": chat_id, "text": text, "parse_mode": parse_mode, "signature": signature, "provisional": provisional})
+        return True
 
-    # Запускаем мониторинг для Raydium
-    asyncio.create_task(monitor_program_ws(address, name, types, chat_id, RAYDIUM_PROGRAM_ID, bot))
+    def confirm_alert(self, chat_id, text, parse_mode=None, signature=None):
+        self.emit({"event": "confirm", "chat_id": chat_id, "text": text, "parse_mode": parse_mode, "signature": signature})
 
-    # Запускаем мониторинг изменений аккаунта (для прямых операций с SOL)
-    asyncio.create_task(monitor_account_ws(address, name, types, chat_id, bot))
+    def retract_alert(self, chat_id, signature):
+        self.emit({"event": "retract", "chat_id": chat_id, "signature": signature})
+
+    def depth(self):
+        return self.telegram_depth
+
+    def checkpoint(self, address, signature):
+        self.emit({"event": "last_tx", "address": address, "signature": signature, "slot": last_seen[address][1]})
+
+    async def heartbeat(self):
+        while True:
+            self.emit({
+                "event": "heartbeat",
+                "wallets": len(tracked_wallets),
+                "covered": subscriptions_covered(),
+                "problems": monitoring_problems(),
+                "counters": [[name, labels, value] for (name, labels), value in metrics.counters.items()],
+                "histograms": [[name, labels, histogram] for (name, labels), histogram in metrics.histograms.items()],
+                "gauges": monitoring_gauges(),
+            })
+            await asyncio.sleep(SHARD_HEARTBEAT_INTERVAL)
+
+# Точка входа воркера: команды фронтенда из stdin, события в stdout (логи идут в stderr)
+async def run_shard_worker(shard_id):
+    global notifier, wallet_registry
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=SHARD_IPC_LIMIT)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    transport, _ = await loop.connect_write_pipe(asyncio.Protocol, sys.stdout)
+    uplink = ShardUplink(transport)
+    notifier = wallet_registry = uplink
+
+    pipeline.start()
+    token_cache.start()
+    loop_lag_monitor.start()
+    heartbeat = asyncio.create_task(uplink.heartbeat())
+    logger.info(f"Шард {shard_id} готов")
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break  # Фронтенд закрыл stdin или умер
+            command = json.loads(line)
+            op = command.get("op")
+            if op == "add":
+                address, chat_id, name = command["address"], command["chat_id"], command["name"]
+                tracked_wallets[(chat_id, name)] = {"address": address, "chat_id": chat_id, "name": name, "types": command["types"]}
+                # Точка отсчёта от фронтенда свежее нашей, если адрес только что переехал сюда
+                if command.get("last_tx") and address not in program_hub.wallets_by_address:
+                    last_seen[address] = [command["last_tx"], None]
+                await monitor_wallet(address, chat_id, name, command["types"])
+            elif op == "remove":
+                unmonitor_wallet(command["address"], command["chat_id"], command["name"])
+                tracked_wallets.pop((command["chat_id"], command["name"]), None)
+            elif op == "depth":
+                uplink.telegram_depth = command["value"]
+    finally:
+        heartbeat.cancel()
+        await loop_lag_monitor.stop()
+        await program_hub.stop()
+        await logs_pool.stop()
+        await account_pool.stop()
+        await backfiller.stop()
+        await pipeline.stop()
+        await token_cache.stop()
+        await tx_fetcher.close()
+        logger.info(f"Шард {shard_id} остановлен")
 
 # Классификация транзакций
-def classify_transaction(tx):
-    meta = tx.get("meta", {})
-    instructions = tx.get("transaction", {}).get("message", {}).get("instructions", [])
-    
-    # Проверяем тип транзакции
-    for instruction in instructions:
-        program_id = instruction.get("programId", "")
-        if "TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623DQ5x" in program_id:
-            # SPL Token Program
-            parsed = instruction.get("parsed", {})
-            if parsed and parsed.get("type") == "transfer":
-                return "transfer"
-            elif parsed and parsed.get("type") == "mint":
-                return "nft_mint"
-        elif "JUP6LkbZbjS1jKKwapdHNy74zcZ3tLUZoi5QNyVTp1" in program_id:
-            # Jupiter Aggregator (свапы)
-            return "swap"
-        elif "6EF8rrecthR5DkcocFusWxY6dvdTQXThK6JVZSJ1C1" in program_id:
-            # Pump Fun (свапы или покупка/продажа токенов)
-            return "swap"
-        elif "675kPX9MHTjS2zt1qfr1NYHuzeLXfQM9H24wFSUt1Mp8" in program_id:
-            # Raydium (свапы)
-            return "swap"
-    
-    # Проверяем изменения баланса SOL
-    if meta.get("preBalances") and meta.get("postBalances"):
-        pre_balances = meta["preBalances"]
-        post_balances = meta["postBalances"]
-        if pre_balances[0] != post_balances[0]:
-            return "receive" if post_balances[0] > pre_balances[0] else "send"
-    
+
+class TxClassification:
+    __slots__ = ("tx_type", "sol_change", "token_mint", "token_change", "fee")
+
+    def __init__(self, tx_type, sol_change=0.0, token_mint=None, token_change=0.0, fee=0):
+        self.tx_type = tx_type
+        self.sol_change = sol_change  # Изменение SOL кошелька без учёта комиссии (включая WSOL)
+        self.token_mint = token_mint  # Основной токен транзакции
+        self.token_change = token_change  # Изменение баланса этого токена, в единицах токена
+        self.fee = fee  # Комиссия в лампортах
+
+# Декодеры инструкций (Instruction): каждый добавляет в hints признаки типа транзакции
+def decode_spl_token(instruction, hints):
+    parsed = instruction.parsed
+    if not isinstance(parsed, ParsedInstruction):
+        return
+    kind = parsed.type
+    if kind in ("transfer", "transferChecked"):
+        hints.add("transfer")
+    elif kind in ("mintTo", "mintToChecked"):
+        hints.add("nft_mint")
+    elif kind in ("approve", "approveChecked", "revoke"):
+        hints.add("approvals")
+    elif kind == "syncNative":
+        hints.add("wrap")
+    elif kind in ("initializeMint", "initializeMint2"):
+        hints.add("contract_creation")
+
+def decode_system(instruction, hints):
+    parsed = instruction.parsed
+    if isinstance(parsed, ParsedInstruction) and parsed.type in ("transfer", "transferWithSeed"):
+        hints.add("transfer")
+
+def decode_swap_program(instruction, hints):
+    hints.add("swap")
+
+# Таблица диспетчеризации programId -> декодер (поиск за O(1))
+PROGRAM_DECODERS = {
+    SYSTEM_PROGRAM_ID: decode_system,
+    SPL_TOKEN_PROGRAM_ID: decode_spl_token,
+    TOKEN_2022_PROGRAM_ID: decode_spl_token,
+    JUPITER_PROGRAM_ID: decode_swap_program,  # Jupiter Aggregator (свапы)
+    PUMP_FUN_PROGRAM_ID: decode_swap_program,  # Pump Fun (покупка/продажа токенов)
+    RAYDIUM_PROGRAM_ID: decode_swap_program,  # Raydium (свапы)
+}
+
+def register_decoder(program_id, decoder):
+    PROGRAM_DECODERS[program_id] = decoder
+
+# Если признаков несколько, побеждает более специфичный
+HINT_PRIORITY = ("swap", "nft_mint", "contract_creation", "approvals", "wrap", "transfer")
+
+EMPTY_META = TransactionMeta()
+
+# Изменения балансов кошелька: SOL по pre/postBalances, токены по pre/postTokenBalances
+def balance_changes(tx, address):
+    meta = tx.meta or EMPTY_META
+    accounts = tx.transaction.message.account_keys
+    fee = meta.fee
+
+    index = 0  # Без адреса смотрим на плательщика комиссии, как раньше
+    if address is not None:
+        index = accounts.index(address) if address in accounts else None
+
+    lamports = 0
+    pre_balances = meta.pre_balances
+    post_balances = meta.post_balances
+    if index is not None and index < len(pre_balances) and index < len(post_balances):
+        lamports = post_balances[index] - pre_balances[index]
+        if index == 0:
+            lamports += fee  # Комиссию показываем отдельно, в сумму свапа она не входит
+    if address is None:
+        address = accounts[0] if accounts else None
+
+    # Дельты токенов по mint для аккаунтов, которыми владеет кошелёк
+    deltas = {}
+    decimals = {}
+    for sign, balances in ((-1, meta.pre_token_balances or ()), (1, meta.post_token_balances or ())):
+        for balance in balances:
+            if balance.owner != address or balance.ui_token_amount is None:
+                continue
+            mint = balance.mint
+            deltas[mint] = deltas.get(mint, 0) + sign * int(balance.ui_token_amount.amount)
+            decimals[mint] = balance.ui_token_amount.decimals
+
+    wsol = deltas.pop(WSOL_MINT, 0)
+    sol_change = (lamports + wsol) / LAMPORTS_PER_SOL
+    token_mint = None
+    token_change = 0.0
+    for mint, delta in deltas.items():
+        change = delta / 10 ** decimals[mint]
+        if delta and (token_mint is None or abs(change) > abs(token_change)):
+            token_mint, token_change = mint, change
+    return sol_change, token_mint, token_change, fee
+
+# tx — Transaction из transaction_decoder
+def classify_transaction(tx, address=None):
+    meta = tx.meta or EMPTY_META
+
+    # Один проход по внешним и внутренним инструкциям
+    hints = set()
+    decoders = PROGRAM_DECODERS
+    for instruction in tx.transaction.message.instructions:
+        decoder = decoders.get(instruction.program_id)
+        if decoder is not None:
+            decoder(instruction, hints)
+    for inner in meta.inner_instructions or ():
+        for instruction in inner.instructions:
+            decoder = decoders.get(instruction.program_id)
+            if decoder is not None:
+                decoder(instruction, hints)
+
+    sol_change, token_mint, token_change, fee = balance_changes(tx, address)
+
+    tx_type = "unknown"
+    for hint in HINT_PRIORITY:
+        if hint in hints:
+            tx_type = hint
+            break
+
+    if tx_type == "swap":
+        # Направление свапа по движению токена относительно кошелька
+        if token_change > 0:
+            tx_type = "swap_buy"
+        elif token_change < 0:
+            tx_type = "swap_sell"
+    elif tx_type == "unknown" and sol_change:
+        # Проверяем изменения баланса SOL
+        tx_type = "receive" if sol_change > 0 else "send"
+
+    return TxClassification(tx_type, sol_change, token_mint, token_change, fee)
+
+# Типы транзакций в меню. Позиция задаёт бит маски, сохранённой в реестре: новые типы — только в конец
+TX_TYPES = [
+    ("Swap", "swap"), ("Swap Buy", "swap_buy"), ("Swap Sell", "swap_sell"),
+    ("Transfer", "transfer"), ("Lending", "lending"),
+    ("NFT Mint", "nft_mint"), ("NFT Trade", "nft_trade"),
+    ("NFT Transfer", "nft_transfer"), ("NFT Lending", "nft_lending"),
+    ("Bridge", "bridge"), ("Reward", "reward"),
+    ("Approvals", "approvals"), ("Perpetual", "perpetual"),
+    ("Option", "option"), ("Wrap", "wrap"),
+    ("NFT liquidation", "nft_liquidation"), ("Contract creation", "contract_creation"),
+    ("Other", "other")
+]
+# Типы классификатора, которых нет в меню, тоже получают биты: маска хранит любой выбор без потерь
+TX_TYPE_BITS = {type_id: 1 << i for i, type_id in enumerate([type_id for _, type_id in TX_TYPES] + ["receive", "send", "unknown"])}
+
+# Биты выбора, под которые попадает тип транзакции (Swap включает Buy и Sell)
+TX_TYPE_MATCH = dict(TX_TYPE_BITS)
+TX_TYPE_MATCH["swap_buy"] |= TX_TYPE_BITS["swap"]
+TX_TYPE_MATCH["swap_sell"] |= TX_TYPE_BITS["swap"]
+
+# Список выбранных типов -> битовая маска
+def types_mask(types):
+    mask = 0
+    for type_id in types:
+        mask |= TX_TYPE_BITS.get(type_id, 0)
+    return mask
+
+# Подходит ли тип транзакции под маску выбранных пользователем типов
+def type_selected(tx_type, types):
+    return TX_TYPE_MATCH.get(tx_type, 0) & types != 0
+
+TX_TYPE_LABELS = dict((type_id, label) for label, type_id in TX_TYPES)
+
+# Классификация по логам программ (для быстрых уведомлений, до getTransaction).
+# Вызванные программы видны по "Program <id> invoke [n]", инструкция — по "Program log: Instruction: <Name>"
+LOG_PROGRAM_HINTS = {
+    SYSTEM_PROGRAM_ID: "transfer",
+    JUPITER_PROGRAM_ID: "swap",
+    PUMP_FUN_PROGRAM_ID: "swap",
+    RAYDIUM_PROGRAM_ID: "swap",
+}
+LOG_INSTRUCTION_HINTS = {
+    **{
+        (program_id, instruction): hint
+        for program_id in (SPL_TOKEN_PROGRAM_ID, TOKEN_2022_PROGRAM_ID)
+        for instruction, hint in (
+            ("Transfer", "transfer"), ("TransferChecked", "transfer"),
+            ("MintTo", "nft_mint"), ("MintToChecked", "nft_mint"),
+            ("Approve", "approvals"), ("ApproveChecked", "approvals"), ("Revoke", "approvals"),
+            ("SyncNative", "wrap"),
+            ("InitializeMint", "contract_creation"), ("InitializeMint2", "contract_creation"),
+        )
+    },
+    # Pump Fun пишет направление свапа прямо в лог
+    (PUMP_FUN_PROGRAM_ID, "Buy"): "swap_buy",
+    (PUMP_FUN_PROGRAM_ID, "Sell"): "swap_sell",
+}
+LOG_HINT_PRIORITY = ("swap_buy", "swap_sell") + HINT_PRIORITY
+LOG_INSTRUCTION_PREFIX = "Program log: Instruction: "
+
+def classify_logs(logs):
+    hints = set()
+    stack = []  # Программы текущей цепочки вызовов
+    for line in logs or ():
+        if line.startswith(LOG_INSTRUCTION_PREFIX):
+            if stack:
+                hint = LOG_INSTRUCTION_HINTS.get((stack[-1], line[len(LOG_INSTRUCTION_PREFIX):]))
+                if hint is not None:
+                    hints.add(hint)
+        elif line.startswith("Program "):
+            program_id, _, rest = line[8:].partition(" ")
+            if rest.startswith("invoke ["):
+                stack.append(program_id)
+                hint = LOG_PROGRAM_HINTS.get(program_id)
+                if hint is not None:
+                    hints.add(hint)
+            elif (rest == "success" or rest.startswith("failed")) and stack:
+                stack.pop()
+    for hint in LOG_HINT_PRIORITY:
+        if hint in hints:
+            return hint
     return "unknown"
 
+# Направление свапа по логам Jupiter и Raydium не видно: быстрое уведомление получают все, кто выбрал любой свап
+PROVISIONAL_MATCH = dict(TX_TYPE_MATCH)
+PROVISIONAL_MATCH["swap"] |= TX_TYPE_BITS["swap_buy"] | TX_TYPE_BITS["swap_sell"]
+
 # Главное меню с кнопками
 def main_menu():
     keyboard = [
@@ -295,20 +2716,9 @@ def main_menu():
 
 # Меню типов транзакций
 def types_menu(selected_types):
-    types = [
-        ("Swap", "swap"), ("Swap Buy", "swap_buy"), ("Swap Sell", "swap_sell"),
-        ("Transfer", "transfer"), ("Lending", "lending"),
-        ("NFT Mint", "nft_mint"), ("NFT Trade", "nft_trade"),
-        ("NFT Transfer", "nft_transfer"), ("NFT Lending", "nft_lending"),
-        ("Bridge", "bridge"), ("Reward", "reward"),
-        ("Approvals", "approvals"), ("Perpetual", "perpetual"),
-        ("Option", "option"), ("Wrap", "wrap"),
-        ("NFT liquidation", "nft_liquidation"), ("Contract creation", "contract_creation"),
-        ("Other", "other")
-    ]
     keyboard = []
     row = []
-    for label, type_id in types:
+    for label, type_id in TX_TYPES:
         emoji = "✅" if type_id in selected_types else "⬜"
         row.append(InlineKeyboardButton(f"{emoji} {label}", callback_data=f"type_{type_id}"))
         if len(row) == 2:
@@ -325,7 +2735,8 @@ def types_menu(selected_types):
 
 # Команда /start
 async def start(update: telegram.Update, context: telegram.ext.ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
+    await notifier.send_reply(
+        update.effective_chat.id,
         "Привет! Я трекер кошельков.\nВыбери действие:",
         reply_markup=main_menu()
     )
@@ -341,16 +2752,17 @@ async def button(update: telegram.Update, context: telegram.ext.ContextTypes.DEF
 
     if data == 'add':
         user_states[user_id] = {'state': 'awaiting_address', 'selected_types': []}
-        await query.message.reply_text("Введите адрес кошелька Solana:")
+        await notifier.send_reply(chat_id, "Введите адрес кошелька Solana:")
     elif data == 'list':
         async with wallet_lock:
-            if not tracked_wallets:
-                await query.message.reply_text("Нет отслеживаемых кошельков.", reply_markup=main_menu())
+            wallets = [wallet for wallet in tracked_wallets.values() if wallet["chat_id"] == chat_id]
+            if not wallets:
+                await notifier.send_reply(chat_id, "Нет отслеживаемых кошельков.", reply_markup=main_menu())
                 return
             response = "Список отслеживаемых кошельков:\n\n"
-            for name, data in tracked_wallets.items():
-                response += f"💼 {name} (Solana)\nКОПИРОВАТЬ\n{data['address']}\n/edit_{random.randint(1000000, 9999999)}\n\n"
-        await query.message.reply_text(response, reply_markup=main_menu())
+            for data in wallets:
+                response += f"💼 {data['name']} (Solana)\nКОПИРОВАТЬ\n{data['address']}\n/edit_{random.randint(1000000, 9999999)}\n\n"
+        await notifier.send_reply(chat_id, response, reply_markup=main_menu())
         logger.info("Список кошельков отправлен")
     elif data == 'menu':
         keyboard = [
@@ -358,18 +2770,18 @@ async def button(update: telegram.Update, context: telegram.ext.ContextTypes.DEF
             [InlineKeyboardButton("📁 List", callback_data='list')],
             [InlineKeyboardButton("📢 Канал @degen_danny", url='https://t.me/degen_danny')]
         ]
-        await query.message.reply_text(
+        await notifier.send_reply(
+            chat_id,
             "Меню:\n"
             "Канал: @degen_danny\n"
             "Выбери действие:",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
     elif data == 'cancel':
-        if user_id in user_states:
-            del user_states[user_id]
-        await query.message.reply_text("Действие отменено.", reply_markup=main_menu())
+        user_states.pop(user_id, None)
+        await notifier.send_reply(chat_id, "Действие отменено.", reply_markup=main_menu())
     elif data.startswith('type_'):
-        type_id = data.split('_')[1]
+        type_id = data.split('_', 1)[1]  # swap_buy, nft_mint, contract_creation: id сам содержит "_"
         if user_id not in user_states:
             return
         selected_types = user_states[user_id].get('selected_types', [])
@@ -383,32 +2795,35 @@ async def button(update: telegram.Update, context: telegram.ext.ContextTypes.DEF
         if user_id not in user_states:
             return
         # Выбираем все типы транзакций
-        all_types = [
-            "swap", "swap_buy", "swap_sell", "transfer", "lending",
-            "nft_mint", "nft_trade", "nft_transfer", "nft_lending",
-            "bridge", "reward", "approvals", "perpetual", "option",
-            "wrap", "nft_liquidation", "contract_creation", "other"
-        ]
+        all_types = [type_id for _, type_id in TX_TYPES]
         user_states[user_id]['selected_types'] = all_types
         await query.message.edit_reply_markup(reply_markup=types_menu(all_types))
     elif data == 'confirm_types':
-        if user_id not in user_states:
+        # Обновления обрабатываются параллельно: состояние забираем сразу, чтобы повторное
+        # нажатие Confirm, пришедшее во время await ниже, ничего не сделало
+        state = user_states.pop(user_id, None)
+        if state is None:
             return
-        state = user_states[user_id]
         name = state.get('name')
         address = state.get('address')
         types = state.get('selected_types', [])
-        if not types:
-            await query.message.reply_text("Выберите хотя бы один тип транзакции.", reply_markup=types_menu(types))
+        # Пустая маска не пропустит ни одной транзакции: такой выбор не принимаем
+        if not types_mask(types):
+            user_states[user_id] = state  # Выбор не закончен
+            await notifier.send_reply(chat_id, "Выберите хотя бы один тип транзакции.", reply_markup=types_menu(types))
             return
         
+        # Имя уникально в пределах чата: тот же адрес в другом чате — отдельная подписка на общий монитор
         async with wallet_lock:
-            tracked_wallets[name] = {"address": address, "types": types, "last_tx": None}
+            previous = tracked_wallets.get((chat_id, name))
+            if previous:
+                unmonitor_wallet(previous["address"], chat_id, name)
+            tracked_wallets[(chat_id, name)] = {"address": address, "chat_id": chat_id, "name": name, "types": types_mask(types)}
+            wallet_registry.save(tracked_wallets[(chat_id, name)])
         # Запускаем мониторинг через все программы
-        await monitor_wallet(address, name, types, chat_id, context.bot)
-        await query.message.reply_text(f"Кошелек {name} добавлен в отслеживание.", reply_markup=main_menu())
+        await monitor_wallet(address, chat_id, name, types_mask(types))
+        await notifier.send_reply(chat_id, f"Кошелек {name} добавлен в отслеживание.", reply_markup=main_menu())
         logger.info(f"Кошелек {name} добавлен: {address}, типы: {types}")
-        del user_states[user_id]
 
 # Обработчик текстовых сообщений
 async def handle_message(update: telegram.Update, context: telegram.ext.ContextTypes.DEFAULT_TYPE):
@@ -416,25 +2831,262 @@ async def handle_message(update: telegram.Update, context: telegram.ext.ContextT
     chat_id = update.message.chat_id
     text = update.message.text
 
-    if user_id not in user_states:
-        await update.message.reply_text("Пожалуйста, используйте кнопки для взаимодействия.", reply_markup=main_menu())
+    # Состояние меняется до первого await: параллельное сообщение видит уже следующий шаг
+    user_state = user_states.get(user_id)
+    if user_state is None:
+        await notifier.send_reply(chat_id, "Пожалуйста, используйте кнопки для взаимодействия.", reply_markup=main_menu())
         return
 
-    state = user_states[user_id]['state']
+    state = user_state['state']
 
     if state == 'awaiting_address':
-        user_states[user_id]['address'] = text
-        user_states[user_id]['state'] = 'awaiting_name'
-        await update.message.reply_text("Введите название кошелька:")
+        user_state['address'] = text
+        user_state['state'] = 'awaiting_name'
+        await notifier.send_reply(chat_id, "Введите название кошелька:")
     elif state == 'awaiting_name':
         name = text
-        user_states[user_id]['name'] = name
-        user_states[user_id]['state'] = 'awaiting_types'
-        await update.message.reply_text("Выберите типы транзакций для отслеживания:", reply_markup=types_menu([]))
+        user_state['name'] = name
+        user_state['state'] = 'awaiting_types'
+        await notifier.send_reply(chat_id, "Выберите типы транзакций для отслеживания:", reply_markup=types_menu([]))
+
+# Проверка здоровья: после стартовой паузы все подписки должны быть живы
+HEALTH_STARTUP_GRACE = float(os.getenv("HEALTH_STARTUP_GRACE", 60))  # Сколько секунд после старта не проверяем подписки
+HEALTH_MAX_LOOP_LAG = 5.0  # Event loop дольше этого считаем зависшим, сек
+started_at = time.monotonic()
+
+def health_problems():
+    problems = []
+    if notifier.task is None or notifier.task.done():
+        problems.append("очередь отправки Telegram не запущена")
+    if loop_lag_monitor.last() > HEALTH_MAX_LOOP_LAG:
+        problems.append(f"event loop задержан на {loop_lag_monitor.last():.1f} с")
+    if shard_coordinator is not None:
+        problems.extend(shard_coordinator.problems())
+    else:
+        problems.extend(monitoring_problems())
+    return problems
+
+# Проблемы мониторинга в этом процессе (в шардированном режиме их считает каждый воркер)
+def monitoring_problems():
+    problems = []
+    full = [stage for stage, queue in pipeline.queues.items() if queue.full()]
+    if full:
+        problems.append(f"переполнены очереди конвейера: {', '.join(full)}")
+    if time.monotonic() - started_at < HEALTH_STARTUP_GRACE:
+        return problems
+    if INGEST_MODE == "logs":
+        missing = len(program_hub.wallets_by_address) - logs_pool.subscribed_count()
+        if missing > 0:
+            problems.append(f"нет logsSubscribe для {missing} адресов")
+        return problems
+    if program_hub.wallets_by_address:
+        for program_id in program_hub.program_ids:
+            if program_id not in program_hub.subscribed:
+                problems.append(f"нет подписки на программу {program_id}")
+    missing = len(program_hub.wallets_by_address) - account_pool.subscribed_count()
+    if missing > 0:
+        problems.append(f"нет подписки на аккаунты {missing} адресов")
+    return problems
+
+# Метрики мониторинга этого процесса: подписки, очереди конвейера и event loop.
+# В шардированном режиме их считает каждый воркер и присылает в отчёте
+def monitoring_gauges():
+    gauges = []
+    for program_id in program_hub.program_ids:
+        gauges.append(("dtracker_active_subscriptions", {"program": program_id}, int(program_id in program_hub.subscribed)))
+    gauges.append(("dtracker_active_subscriptions", {"program": "account"}, account_pool.subscribed_count()))
+    gauges.append(("dtracker_active_subscriptions", {"program": "logs"}, logs_pool.subscribed_count()))
+    gauges.append(("dtracker_logs_connections", {}, len(logs_pool.connections)))
+    gauges.append(("dtracker_account_connections", {}, len(account_pool.connections)))
+    for stage, depth in pipeline.depths().items():
+        gauges.append(("dtracker_pipeline_queue_depth", {"stage": stage}, depth))
+    return gauges + loop_lag_gauges()
+
+def loop_lag_gauges():
+    return [
+        ("dtracker_event_loop_lag_seconds", {}, loop_lag_monitor.last()),
+        ("dtracker_event_loop_lag_max_seconds", {}, loop_lag_monitor.max_lag),
+    ]
+
+def metrics_gauges():
+    # Хаб и конвейер фронтенда при шардах простаивают: вместо них — отчёты воркеров с меткой shard
+    gauges = loop_lag_gauges() if shard_coordinator is not None else monitoring_gauges()
+    gauges.append(("dtracker_telegram_queue_depth", {}, notifier.depth()))
+    gauges.append(("dtracker_telegram_sent_total", {}, notifier.sent))
+    gauges.append(("dtracker_telegram_retries_total", {}, notifier.retries))
+    gauges.append(("dtracker_telegram_digests_total", {}, notifier.digests))
+    gauges.append(("dtracker_tracked_wallets", {}, len(tracked_wallets)))
+    gauges.append(("dtracker_tracked_addresses", {}, len({wallet["address"] for wallet in tracked_wallets.values()})))
+    if shard_coordinator is not None:
+        gauges.extend(shard_coordinator.gauges())
+    for address, (_, slot) in last_seen.items():
+        if slot is not None:
+            gauges.append(("dtracker_wallet_last_seen_slot", {"address": address}, slot))
+    return gauges
+
+# Маршруты HTTP-сервера: (method, path) -> handler(headers, body) -> (status, content_type, body)
+async def handle_metrics(headers, body):
+    if shard_coordinator is None:
+        return 200, "text/plain; version=0.0.4", metrics.render(metrics_gauges())
+    return 200, "text/plain; version=0.0.4", metrics.render(metrics_gauges(), shard_coordinator.counters(), shard_coordinator.histograms())
+
+async def handle_healthz(headers, body):
+    problems = health_problems()
+    if problems:
+        return 503, "text/plain; charset=utf-8", "\n".join(problems) + "\n"
+    return 200, "text/plain; charset=utf-8", "ok\n"
+
+telegram_app = None  # Application, которому вебхук передаёт обновления
+
+# Вебхук: проверяем секрет и сразу отвечаем 200, обработка идёт в очереди обновлений приложения
+async def handle_telegram_webhook(headers, body):
+    if headers.get("x-telegram-bot-api-secret-token") != WEBHOOK_SECRET:
+        return 403, "text/plain", "forbidden\n"
+    update = telegram.Update.de_json(json_decoder.decode(body), telegram_app.bot)
+    await telegram_app.update_queue.put(update)
+    metrics.inc("dtracker_telegram_updates_total")
+    return 200, "text/plain", "ok\n"
+
+http_routes = {
+    ("GET", "/metrics"): handle_metrics,
+    ("GET", "/healthz"): handle_healthz,
+    ("GET", "/"): handle_healthz,
+    ("HEAD", "/"): handle_healthz,
+}
+if TELEGRAM_MODE == "webhook":
+    http_routes[("POST", WEBHOOK_PATH)] = handle_telegram_webhook
+
+HTTP_STATUS_TEXT = {200: "OK", 403: "Forbidden", 404: "Not Found", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+HTTP_MAX_BODY = 1 << 20
+
+# Минимальный асинхронный HTTP/1.1 сервер на порту PORT (без сторонних зависимостей)
+async def handle_http_connection(reader, writer):
+    http_connections.add(writer)
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, _, value = line.decode("latin-1").partition(":")
+                headers[key.strip().lower()] = value.strip()
+
+            length = int(headers.get("content-length", 0))
+            handler = http_routes.get((method, path.split("?", 1)[0]))
+            if length > HTTP_MAX_BODY:
+                status, content_type, body = 413, "text/plain", "payload too large\n"
+            elif handler is None:
+                await reader.readexactly(length)
+                status, content_type, body = 404, "text/plain", "not found\n"
+            else:
+                request_body = await reader.readexactly(length)
+                try:
+                    status, content_type, body = await handler(headers, request_body)
+                except Exception as e:
+                    logger.error(f"Ошибка обработки HTTP {method} {path}: {str(e)}")
+                    status, content_type, body = 500, "text/plain", "internal error\n"
+
+            data = body.encode() if isinstance(body, str) else body
+            keep_alive = headers.get("connection", "").lower() != "close" and status != 413
+            writer.write(
+                f"HTTP/1.1 {status} {HTTP_STATUS_TEXT.get(status, 'OK')}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+                + (data if method != "HEAD" else b"")
+            )
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        http_connections.discard(writer)
+        writer.close()
+
+http_server = None
+http_connections = set()  # Открытые keep-alive соединения (вебхук Telegram держит их постоянно)
+
+async def start_http_server():
+    global http_server
+    http_server = await asyncio.start_server(handle_http_connection, "0.0.0.0", PORT)
+    logger.info(f"HTTP-сервер метрик запущен на порту {PORT}")
+
+async def stop_http_server():
+    if http_server is not None:
+        http_server.close()
+        # Закрываем простаивающие keep-alive соединения, иначе их задачи переживут event loop
+        for writer in list(http_connections):
+            writer.close()
+        await http_server.wait_closed()
+
+# Запускаем фоновые службы, когда у приложения уже есть event loop и bot
+async def post_init(application):
+    global shard_coordinator, telegram_app
+    telegram_app = application
+    notifier.start(application.bot)
+    wallet_registry.start()
+    token_cache.start()
+    loop_lag_monitor.start()
+    if SHARD_WORKERS > 0:
+        shard_coordinator = ShardCoordinator(SHARD_WORKERS)
+        shard_coordinator.start()
+    else:
+        pipeline.start()
+    await start_http_server()
+    asyncio.create_task(restore_wallets())
+
+# Освобождаем сетевые ресурсы при остановке бота
+async def post_shutdown(application):
+    await stop_http_server()
+    await loop_lag_monitor.stop()
+    if shard_coordinator is not None:
+        await shard_coordinator.stop()
+    await program_hub.stop()
+    await logs_pool.stop()
+    await account_pool.stop()
+    await pipeline.stop()
+    await backfiller.stop()
+    await notifier.stop()
+    await wallet_registry.stop()
+    await token_cache.stop()
+    await tx_fetcher.close()
+
+# Режим вебхука: тот же жизненный цикл, что у run_polling, но обновления приходят на наш HTTP-сервер
+async def run_webhook(application):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    # Вебхук не снимаем при остановке: пока бот перезапускается, Telegram копит обновления у себя
+    await application.bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+        allowed_updates=telegram.Update.ALL_TYPES, max_connections=TELEGRAM_UPDATE_CONCURRENCY,
+    )
+    logger.info(f"Вебхук установлен: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+    try:
+        await stop.wait()
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await post_shutdown(application)
 
 def main():
-    # Создаём приложение
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Создаём приложение; обновления обрабатываются параллельно, чтобы кнопки не ждали друг друга
+    application = (
+        Application.builder().token(BOT_TOKEN).base_url(TELEGRAM_API_URL)
+        .concurrent_updates(TELEGRAM_UPDATE_CONCURRENCY)
+        .post_init(post_init).post_shutdown(post_shutdown).build()
+    )
 
     # Добавляем обработчики
     application.add_handler(CommandHandler("start", start))
@@ -442,7 +3094,13 @@ def main():
     application.add_handler(MessageHandler(filters.Text() & ~filters.Command(), handle_message))
 
     # Запускаем бота
-    application.run_polling()
+    if TELEGRAM_MODE == "webhook":
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 2 and sys.argv[1] == "--shard-worker":
+        asyncio.run(run_shard_worker(int(sys.argv[2])))
+    else:
+        main()